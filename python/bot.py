@@ -17,7 +17,13 @@ from datetime import datetime
 from os import path, listdir
 from discord.ext.commands import Bot, when_mentioned_or
 from discord import DMChannel, Message, Activity, Intents, AllowedMentions
-from aiohttp import ClientSession, ClientTimeout
+from utils.pipeline import MessagePipeline
+from utils.msgstats import MessageStatsStore
+from utils.state import open_state_store
+from utils.http import (CachedSession, HttpMetrics, create_client_session,
+                        DEFAULT_CACHE_RULES, DEFAULT_HOST_LIMITS, DEFAULT_TIMEOUTS)
+from utils.singleflight import SingleFlight
+from utils.outbox import Outbox
 
 
 class Felix(Bot):
@@ -28,13 +34,43 @@ class Felix(Bot):
         with open('../config.json') as conffile:
             self.config = json.load(conffile)
         self.last_errors = []
+        # Namespaces that hold sets of member ids
+        self.state = open_state_store(self.config, member_keys=('jailed',))
+        self.message_pipeline = MessagePipeline(self)
+        self.message_stats = MessageStatsStore('../message_stats.db')
+        # Identical calls that run at the same time share one result
+        self.singleflight = SingleFlight()
+        self.http_metrics = HttpMetrics()
+        # Multi-page command output is sent through this per-channel queue
+        self.outbox = Outbox()
 
     async def start(self, *args, **kwargs):
-        self.session = ClientSession(timeout=ClientTimeout(total=30))
+        # Rules of the config are checked before the default rules
+        cache_rules = [tuple(rule) for rule in self.config.get('http_cache_rules', [])]
+        http_config = self.config.get('http', {})
+        timeouts = [tuple(rule) for rule in http_config.get('timeouts', [])]
+        self.session = CachedSession(
+            create_client_session(http_config, self.http_metrics),
+            rules=cache_rules + DEFAULT_CACHE_RULES,
+            singleflight=self.singleflight,
+            spill_dir='../cache/http',
+            timeouts=timeouts + DEFAULT_TIMEOUTS,
+            host_limits={**DEFAULT_HOST_LIMITS, **http_config.get('host_limits', {})},
+            circuit_threshold=http_config.get('circuit_threshold', 5),
+            circuit_reset_timeout=http_config.get('circuit_reset_timeout', 30)
+        )
         await super().start(self.config["bot_key"], *args, **kwargs)
 
     async def close(self):
+        self.outbox.cancel()
+        # The chat log buffers lines and emkc messages - they are written and
+        # sent before the session and the stores are closed
+        chatlog = self.get_cog('Chat Log')
+        if chatlog is not None:
+            await chatlog.close()
         await self.session.close()
+        self.message_stats.close()
+        self.state.close()
         await super().close()
 
     def user_is_admin(self, user):
@@ -49,71 +85,72 @@ class Felix(Bot):
         superusers = self.config['superusers']
         return user.id in superusers
 
-client = Felix(
-    command_prefix=when_mentioned_or('felix ', 'Felix '),
-    description='Hi I am Felix!',
-    max_messages=15000,
-    intents=Intents.all(),
-    allowed_mentions=AllowedMentions(everyone=False, users=True, roles=True)
-)
-
-STARTUP_EXTENSIONS = []
-
-for file in listdir(path.join(path.dirname(__file__), 'cogs/')):
-    filename, ext = path.splitext(file)
-    if '.py' in ext:
-        STARTUP_EXTENSIONS.append(f'cogs.{filename}')
-
-for extension in reversed(STARTUP_EXTENSIONS):
-    try:
-        client.load_extension(f'{extension}')
-    except Exception as e:
-        client.last_errors.append((e, datetime.utcnow(), None, None))
-        exc = f'{type(e).__name__}: {e}'
-        print(f'Failed to load extension {extension}\n{exc}')
-
-
-@client.event
-async def on_ready():
-    main_id = client.config['main_guild']
-    client.main_guild = client.get_guild(main_id) or client.guilds[0]
-    print('\nActive in these guilds/servers:')
-    [print(g.name) for g in client.guilds]
-    print('\nMain guild:', client.main_guild.name)
-    print('\nFelix-Python started successfully')
-    return True
-
-
-@client.event
-async def on_error(event_method, *args, **kwargs):
-    """|coro|
-
-    The default error handler provided by the client.
-
-    By default this prints to :data:`sys.stderr` however it could be
-    overridden to have a different implementation.
-    Check :func:`~discord.on_error` for more details.
-    """
-    print('Default Handler: Ignoring exception in {}'.format(event_method), file=sys.stderr)
-    traceback.print_exc()
-    # --------------- custom code below -------------------------------
-    # Saving the error if it resulted from a message edit
-    if len(args) > 1:
-        a1, a2, *_ = args
-        if isinstance(a1, Message) and isinstance(a2, Message):
-            client.last_errors.append((sys.exc_info()[1], datetime.utcnow(), a2, a2.content))
-        await client.change_presence(
-            activity=Activity(name='ERROR encountered', url=None, type=3)
-        )
-
-
-@client.event
-async def on_message(msg):
-    # Ignore DMs
-    if isinstance(msg.channel, DMChannel):
-        return
-    await client.process_commands(msg)
-
-
-client.run()
-print('Felix-Python has exited')
+    async def on_ready(self):
+        main_id = self.config['main_guild']
+        self.main_guild = self.get_guild(main_id) or self.guilds[0]
+        print('\nActive in these guilds/servers:')
+        [print(g.name) for g in self.guilds]
+        print('\nMain guild:', self.main_guild.name)
+        print('\nFelix-Python started successfully')
+        return True
+
+    async def on_error(self, event_method, *args, **kwargs):
+        """|coro|
+
+        The default error handler provided by the client.
+
+        By default this prints to :data:`sys.stderr` however it could be
+        overridden to have a different implementation.
+        Check :func:`~discord.on_error` for more details.
+        """
+        print('Default Handler: Ignoring exception in {}'.format(event_method), file=sys.stderr)
+        traceback.print_exc()
+        # --------------- custom code below -------------------------------
+        # Saving the error if it resulted from a message edit
+        if len(args) > 1:
+            a1, a2, *_ = args
+            if isinstance(a1, Message) and isinstance(a2, Message):
+                self.last_errors.append((sys.exc_info()[1], datetime.utcnow(), a2, a2.content))
+            await self.change_presence(
+                activity=Activity(name='ERROR encountered', url=None, type=3)
+            )
+
+    async def on_message(self, msg):
+        # Run the message through all pipeline stages registered by cogs
+        if await self.message_pipeline.dispatch(msg):
+            return
+        # Ignore DMs
+        if isinstance(msg.channel, DMChannel):
+            return
+        await self.process_commands(msg)
+
+
+def load_extensions(client):
+    startup_extensions = []
+
+    for file in listdir(path.join(path.dirname(__file__), 'cogs/')):
+        filename, ext = path.splitext(file)
+        if '.py' in ext:
+            startup_extensions.append(f'cogs.{filename}')
+
+    for extension in reversed(startup_extensions):
+        try:
+            client.load_extension(f'{extension}')
+        except Exception as e:
+            client.last_errors.append((e, datetime.utcnow(), None, None))
+            exc = f'{type(e).__name__}: {e}'
+            print(f'Failed to load extension {extension}\n{exc}')
+
+
+# Worker processes (see cogs/graph.py) import this file - they must not start the bot
+if __name__ == '__main__':
+    client = Felix(
+        command_prefix=when_mentioned_or('felix ', 'Felix '),
+        description='Hi I am Felix!',
+        max_messages=15000,
+        intents=Intents.all(),
+        allowed_mentions=AllowedMentions(everyone=False, users=True, roles=True)
+    )
+    load_extensions(client)
+    client.run()
+    print('Felix-Python has exited')
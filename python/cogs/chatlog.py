@@ -1,34 +1,125 @@
 """This is a cog for a discord.py bot.
 It will log all messages the bot can see to a file and to the emkc chatlog api
+and count them in the local message statistics (client.message_stats)
+
+Messages are buffered and written to the file in batches off the event loop.
+Messages for the emkc api are queued and sent by a background task.
+The log file is rotated daily and closed segments are compressed and indexed
+(see utils/logstore.py).
 
 Commands:
-    None
+    chatlog         send the chat log of a time window as a file
 
+Only users that have an admin role can use the commands.
 """
-from discord.ext import commands
-from discord import DMChannel
+import asyncio
+import time
+from collections import deque
+from datetime import datetime
+from io import BytesIO
+from aiohttp import ClientError
+from discord import File
+from discord.ext import commands, tasks
+from utils.circuit import CircuitOpenError, CLOSED, OPEN
+from utils.logstore import ChatLogStore
 
+# pylint: disable=E1101
 
 # set up log path
 LOG_FILENAME = '../logs/discord_chat.log'
+# The log file is rotated every day or when it gets bigger than
+LOG_MAX_SIZE = 256_000_000  # Bytes
+# Maximum number of lines the chatlog command will send
+LOG_WINDOW_MAX_LINES = 50_000
+# and maximum size of the file - Discord's upload limit is 8 MB
+LOG_WINDOW_MAX_BYTES = 7_900_000  # Bytes
+# Buffered messages are written to the log file every
+LOG_WRITE_INTERVAL = 2  # Seconds
+# Maximum number of buffered lines if the log file can't be written - the
+# oldest lines are dropped
+LOG_MAX_PENDING_LINES = 100_000
+# Queued messages are sent to emkc every
+EMKC_SEND_INTERVAL = 2  # Seconds
+# Maximum number of messages sent to emkc per interval
+EMKC_BATCH_SIZE = 100
+# Maximum number of requests to emkc at the same time
+EMKC_CONCURRENCY = 4
+# Number of attempts for each message before it is dropped
+EMKC_TRIES = 3
+# Maximum number of messages waiting for emkc - if emkc can't keep up
+# the oldest messages are dropped
+EMKC_QUEUE_SIZE = 5000
+# If a whole batch fails the next one is delayed (doubling up to)
+EMKC_MAX_BACKOFF = 60  # Seconds
+# When the bot shuts down the queued messages are sent for at most
+EMKC_SHUTDOWN_TIMEOUT = 10  # Seconds
+EMKC_GUILD_ID = 473161189120147456
 
 
 class ChatLog(commands.Cog, name='Chat Log'):
     def __init__(self, client):
         self.client = client
-        self.logfile = open(LOG_FILENAME, 'a', encoding='utf-8')
+        self.store = ChatLogStore(LOG_FILENAME, max_size=LOG_MAX_SIZE)
+        self.pending_lines = []
+        # Entries: (data, number of failed attempts)
+        self.emkc_queue = deque(maxlen=EMKC_QUEUE_SIZE)
+        self.emkc_dropped = 0
+        self.emkc_backoff = 0
+        self.emkc_retry_at = 0
+        self.closed = False
+        self.write_lock = asyncio.Lock()
+        self.write_task.start()
+        self.emkc_task.start()
+        # Messages of bots and DMs are not passed to this stage
+        self.client.message_pipeline.add_stage('chatlog', self.process_message, 30)
 
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        if msg.author.bot:
-            # Dont log messages of bots
+    def cog_unload(self):
+        self.client.message_pipeline.remove_stage('chatlog')
+        self.write_task.cancel()
+        self.emkc_task.cancel()
+        if self.closed:
             return
-        if isinstance(msg.channel, DMChannel):
-            # Don't log DMs
+        lines, self.pending_lines = self.pending_lines, []
+        self.store.write(lines)
+        self.store.close()
+        self.closed = True
+
+    async def close(self):
+        """Write the buffered lines, send the queued messages to emkc and
+        close the log - Felix.close() calls this when the bot shuts down"""
+        if self.closed:
             return
-        if not msg.channel.guild.id == self.client.main_guild.id:
+        self.client.message_pipeline.remove_stage('chatlog')
+        self.write_task.cancel()
+        self.emkc_task.cancel()
+        await self.write_pending()
+        try:
+            await asyncio.wait_for(self.drain_emkc_queue(), EMKC_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        if self.emkc_queue:
+            print(f'WARNING: {len(self.emkc_queue)} chat messages were not sent to EMKC')
+        self.store.close()
+        self.closed = True
+
+    async def drain_emkc_queue(self):
+        # Stops when a batch failed (retry_at is set) or the circuit is open
+        while self.emkc_queue and time.monotonic() >= self.emkc_retry_at:
+            if self.client.session.circuit('emkc.org').state == OPEN:
+                return
+            await self.send_emkc_batch()
+
+    async def cog_check(self, ctx):
+        return self.client.user_is_admin(ctx.author)
+
+    # ----------------------------------------------
+    # Message pipeline stage
+    # ----------------------------------------------
+    async def process_message(self, ctx):
+        if not ctx.is_main_guild:
             # Don't log messages on servers other than the main server
-            return
+            return False
+        msg = ctx.msg
         paginator = [
             msg.created_at.isoformat(),
             str(msg.channel),
@@ -36,17 +127,20 @@ class ChatLog(commands.Cog, name='Chat Log'):
             msg.content.replace('\n', '\\n'),
             msg.author.id
         ]
-        self.logfile.write('|'.join(paginator[:-1]) + '\n')
-        self.logfile.flush()
+        self.pending_lines.append('|'.join(paginator[:-1]) + '\n')
+        self.client.message_stats.add(
+            msg.created_at.date().isoformat(),
+            msg.author.id,
+            paginator[2],
+            msg.channel.id,
+            paginator[1]
+        )
 
         # send chat message to emkc
-        if not msg.channel.guild.id == 473161189120147456:
+        if not msg.channel.guild.id == EMKC_GUILD_ID:
             # prevent querying the emkc api if it's not felix
-            return
+            return False
 
-        headers = {
-            'authorization': self.client.config['emkc_key']
-        }
         data = {
             'timestamp': paginator[0],
             'channel': paginator[1],
@@ -54,13 +148,162 @@ class ChatLog(commands.Cog, name='Chat Log'):
             'message': paginator[3],
             'discord_id': paginator[4]
         }
-        async with self.client.session.post(
-            'https://emkc.org/api/internal/chats',
-            headers=headers,
-            data=data
-        ) as response:
-            if response.status != 200:
-                print(f'ERROR while sending chat log to EMKC. Response {response.status}')
+        if len(self.emkc_queue) == self.emkc_queue.maxlen:
+            self.emkc_dropped += 1
+        self.emkc_queue.append((data, 0))
+        return False
+
+    # ----------------------------------------------
+    # Helper Functions
+    # ----------------------------------------------
+    def read_window(self, start, end):
+        """Return the log lines from start to end as (lines, limit reached) -
+        this runs in an executor thread"""
+        lines = []
+        size = 0
+        for line in self.store.read_window(start.isoformat(), end.isoformat()):
+            encoded = line.encode('utf-8')
+            if size + len(encoded) > LOG_WINDOW_MAX_BYTES:
+                return lines, True
+            lines.append(encoded)
+            size += len(encoded)
+            if len(lines) >= LOG_WINDOW_MAX_LINES:
+                return lines, True
+        return lines, False
+
+    async def write_pending(self):
+        """Write the buffered lines to the log file
+
+        The lock makes sure batches are written in order.
+        """
+        async with self.write_lock:
+            if not self.pending_lines:
+                return
+            lines, self.pending_lines = self.pending_lines, []
+            try:
+                await self.client.loop.run_in_executor(None, self.store.write, lines)
+            except Exception as e:
+                print(f'ERROR while writing chat log. {type(e).__name__}: {e}')
+                # The lines are written with the next batch
+                self.pending_lines = (lines + self.pending_lines)[-LOG_MAX_PENDING_LINES:]
+
+    async def post_chat(self, data, semaphore):
+        """Send one chat message to emkc - return True on success
+
+        Returns None if the message was not sent because the circuit breaker
+        of emkc is open.
+        """
+        headers = {
+            'authorization': self.client.config['emkc_key']
+        }
+        async with semaphore:
+            try:
+                async with self.client.session.post(
+                    'https://emkc.org/api/internal/chats',
+                    headers=headers,
+                    data=data
+                ) as response:
+                    if response.status == 200:
+                        return True
+                    print(f'ERROR while sending chat log to EMKC. Response {response.status}')
+            except CircuitOpenError:
+                return None
+            except (ClientError, asyncio.TimeoutError) as e:
+                print(f'ERROR while sending chat log to EMKC. {type(e).__name__}: {e}')
+        return False
+
+    # ----------------------------------------------
+    # Cog Tasks
+    # ----------------------------------------------
+    @tasks.loop(seconds=LOG_WRITE_INTERVAL)
+    async def write_task(self):
+        # The loop would stop for good on an unhandled exception
+        try:
+            await self.client.message_stats.flush()
+        except Exception as e:
+            print(f'ERROR while writing message stats. {type(e).__name__}: {e}')
+        await self.write_pending()
+
+    @tasks.loop(seconds=EMKC_SEND_INTERVAL)
+    async def emkc_task(self):
+        # The loop would stop for good on an unhandled exception
+        try:
+            await self.send_emkc_batch()
+        except Exception as e:
+            print(f'ERROR while sending chat log to EMKC. {type(e).__name__}: {e}')
+
+    async def send_emkc_batch(self):
+        if self.emkc_dropped:
+            print(f'WARNING: dropped {self.emkc_dropped} chat messages - EMKC queue is full')
+            self.emkc_dropped = 0
+        if not self.emkc_queue or time.monotonic() < self.emkc_retry_at:
+            return
+        circuit_state = self.client.session.circuit('emkc.org').state
+        if circuit_state == OPEN:
+            # The messages stay queued until emkc is reachable again
+            return
+        # A single message probes if emkc is back
+        batch_size = EMKC_BATCH_SIZE if circuit_state == CLOSED else 1
+        batch = [
+            self.emkc_queue.popleft()
+            for _ in range(min(batch_size, len(self.emkc_queue)))
+        ]
+        semaphore = asyncio.Semaphore(EMKC_CONCURRENCY)
+        results = await asyncio.gather(
+            *(self.post_chat(data, semaphore) for data, _ in batch),
+            return_exceptions=True
+        )
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f'ERROR while sending chat log to EMKC. {type(result).__name__}: {result}')
+                results[i] = False
+        # Messages that were not sent because of the circuit breaker keep their tries
+        failed = [
+            (data, tries + (success is False))
+            for (data, tries), success in zip(batch, results)
+            if not success and tries + (success is False) < EMKC_TRIES
+        ]
+        # Failed messages go back to the front of the queue if there is room
+        room = EMKC_QUEUE_SIZE - len(self.emkc_queue)
+        self.emkc_queue.extendleft(reversed(failed[:room]))
+        if any(results):
+            self.emkc_backoff = 0
+        else:
+            backoff = max(self.emkc_backoff * 2, EMKC_SEND_INTERVAL)
+            self.emkc_backoff = min(backoff, EMKC_MAX_BACKOFF)
+            self.emkc_retry_at = time.monotonic() + self.emkc_backoff
+
+    # ----------------------------------------------
+    # Cog Commands
+    # ----------------------------------------------
+    @commands.command(
+        name='chatlog',
+        hidden=True,
+    )
+    async def chatlog(self, ctx, start: str, end: str = None):
+        """Send the chat log from [start] to [end] (UTC) as a file
+
+        Example: felix chatlog 2021-05-01T20:00 2021-05-01T21:30
+        [end] defaults to now"""
+        try:
+            start = datetime.fromisoformat(start)
+            end = datetime.fromisoformat(end) if end else datetime.utcnow()
+        except ValueError:
+            raise commands.BadArgument('Please use the format YYYY-MM-DDTHH:MM')
+        await ctx.trigger_typing()
+        # Make sure lines that are still buffered are part of the result
+        await self.write_pending()
+        lines, limit_reached = await self.client.loop.run_in_executor(
+            None, self.read_window, start, end
+        )
+        if not lines:
+            await ctx.send('Nothing found')
+            return
+        info = f'{len(lines)} lines'
+        if limit_reached:
+            info += ' (limit reached)'
+        log = BytesIO(b''.join(lines))
+        await ctx.send(f'`{info}`', file=File(log, filename='chatlog.txt'))
 
 
 def setup(client):
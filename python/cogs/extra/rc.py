@@ -21,29 +21,34 @@ class RemoteControl(commands.Cog, command_attrs=dict(hidden=True)):
         self.rc_user = None
         self.rc_target_channel = None
         self.rc_active = False
+        self.client.message_pipeline.add_stage('rc', self.process_message, 50)
+
+    def cog_unload(self):
+        self.client.message_pipeline.remove_stage('rc')
 
     async def cog_check(self, ctx):
         return self.client.user_is_admin(ctx.author)
 
     # ----------------------------------------------
-    # Cog Event listeners
+    # Message pipeline stage
     # ----------------------------------------------
-    @commands.Cog.listener()
-    async def on_message(self, msg):
+    async def process_message(self, ctx):
         if not self.rc_active:
-            return
-        if msg.author.bot:
-            return
+            return False
+        msg = ctx.msg
         if msg.channel == self.rc_target_channel:
             await self.rc_channel.send(msg.author.name + ':  ' + msg.content)
         elif msg.channel == self.rc_channel:
             if not msg.author == self.rc_user:
-                return
+                return False
             if msg.content.startswith('felix'):
-                return
+                return False
             await self.rc_target_channel.send(msg.content)
-        else:
-            return
+        return False
+
+    # ----------------------------------------------
+    # Cog Event listeners
+    # ----------------------------------------------
 
     @commands.Cog.listener()
     async def on_typing(self, channel, user, when):
@@ -4,7 +4,7 @@ It adds Yarr
 import random
 from datetime import datetime as dt
 from discord.ext import commands
-from discord import Activity, DMChannel
+from discord import Activity
 
 
 class Yarr(commands.Cog, command_attrs=dict(hidden=True)):
@@ -14,23 +14,22 @@ class Yarr(commands.Cog, command_attrs=dict(hidden=True)):
         self.chance = 4
         self.cooldown = 30
         random.seed()
+        self.client.message_pipeline.add_stage('yarr', self.process_message, 70)
 
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        if msg.author.bot:
-            return
-        if isinstance(msg.channel, DMChannel):
-            # Ignore DM
-            return
+    def cog_unload(self):
+        self.client.message_pipeline.remove_stage('yarr')
+
+    async def process_message(self, ctx):
         if random.randint(1, 100 // self.chance) == 1:
             if (dt.utcnow() - self.last_yarr).total_seconds() < self.cooldown:
-                return
+                return False
             yarr = self.get_yarr() + '!'
-            await msg.channel.send(yarr)
+            await ctx.channel.send(yarr)
             await self.client.change_presence(
                 activity=Activity(name=yarr, type=0)
             )
             self.last_yarr = dt.utcnow()
+        return False
 
     def get_yarr(self):
         yarrs = [
@@ -30,40 +30,104 @@ from datetime import datetime as dt
 from urllib.parse import quote_plus
 import discord
 
-from discord.ext import commands, tasks
-from discord import Embed, DMChannel, Member
+from discord.ext import commands
+from discord import Embed, Member
+
+from utils.rules import RuleEngine
+from utils.startupdata import StartupData
 
 # pylint: disable=E1101
 
+UNIT_ALIASES = {
+    'mile': 'miles',
+    'kilometer': 'km',
+    'kilometers': 'km',
+    'kilometre': 'km',
+    'kilometres': 'km',
+    'fahrenheit': '°f',
+    '°fahrenheit': '°f',
+    'celsius': '°c',
+    '°celsius': '°c',
+}
+CONVERSIONS = {
+    'miles': (lambda x: x*1.609344, 'km'),
+    'km': (lambda x: x*0.6213712, 'miles'),
+    '°f': (lambda x: (x-32)/1.8, '°C'),
+    '°c': (lambda x: x*1.8+32, '°F'),
+    'lb': (lambda x: x*0.4535924, 'kg'),
+    'kg': (lambda x: x*2.204623, 'lb'),
+}
+
+
+async def load_cat_http_codes(session):
+    async with session.get('https://http.cat/') as response:
+        response.raise_for_status()
+        text = await response.text()
+        http_codes = re.findall(r'<a href="/(\d{3})">', text)
+        if not http_codes:
+            raise ValueError('no status codes found on http.cat')
+        http_codes.append(0)
+        return [int(x) for x in http_codes]
+
+
+async def load_dog_http_codes(session):
+    async with session.get('https://httpstatusdogs.com/') as response:
+        response.raise_for_status()
+        text = await response.text()
+        http_codes_dog = re.findall(r'<a href=\"(\d{3})-[^\"]*\"', text)
+        if not http_codes_dog:
+            raise ValueError('no status codes found on httpstatusdogs.com')
+        return [int(x) for x in http_codes_dog]
+
+
+async def load_chuck_categories(session):
+    async with session.get('https://api.chucknorris.io/jokes/categories') as response:
+        response.raise_for_status()
+        categories = await response.json()
+        return [x for x in categories if x != 'explicit']
+
 
 class General(commands.Cog, name='General'):
     def __init__(self, client):
         self.client = client
-        self.load_cat_http_codes.start()
-        self.load_dog_http_codes.start()
-        self.load_chuck_http_codes.start()
-        self.re_converter = re.compile(r'(?i)(?P<num>[0-9]+(?:\.[0-9]*)?)\s?(?P<unit>[a-zA-Z°]+)')
-
-    @tasks.loop(count=1)
-    async def load_cat_http_codes(self):
-        async with self.client.session.get('https://http.cat/') as response:
-            text = await response.text()
-            http_codes = re.findall(r'<a href="/(\d{3})">', text)
-            http_codes.append(0)
-            self.http_codes = [int(x) for x in http_codes]
-
-    @tasks.loop(count=1)
-    async def load_dog_http_codes(self):
-        async with self.client.session.get('https://httpstatusdogs.com/') as response:
-            text = await response.text()
-            http_codes_dog = re.findall(r'<a href=\"(\d{3})-[^\"]*\"', text)
-            self.http_codes_dog = [int(x) for x in http_codes_dog]
-
-    @tasks.loop(count=1)
-    async def load_chuck_http_codes(self):
-        async with self.client.session.get('https://api.chucknorris.io/jokes/categories') as response:
-            categories = await response.json()
-            self.chuck_categories = [x for x in categories if x != 'explicit']
+        # Lists loaded from third party sites - cached in ../cache
+        self.data = StartupData(client, 'general')
+        self.data.register('http_codes', load_cat_http_codes, default=[])
+        self.data.register('http_codes_dog', load_dog_http_codes, default=[])
+        self.data.register('chuck_categories', load_chuck_categories, default=[])
+        self.data_task = self.client.loop.create_task(self.data.run())
+        self.client.message_pipeline.add_stage('general', self.process_message, 60)
+        self.rules = RuleEngine()
+        self.rules.add(r'what a twist', '` - directed by M. Night Shyamalan.`')
+        self.rules.add(
+            r'(?:the|this) (?:current )?year is (?:almost |basically )?(?:over|done|finished)',
+            lambda match: self.get_year_string()
+        )
+        self.rules.add(r'send bobs and vagene', '😏 *sensible chuckle*')
+        self.rules.add(r'^(?:hi|what\'s up|yo|hey|hello) felix', 'hello')
+        self.rules.add(r'^felix should (?:i|he|she|they|we|<@!?\d+>)', self.get_entropy_answer)
+        self.rules.add(r'^html is a programming language', 'no it\'s not, don\'t be silly')
+        self.rules.add(r'^you wanna fight, felix\?', 'bring it on pal (╯°□°）╯︵ ┻━┻')
+        self.rules.add(r'^arrays start at 0', 'arrays definitely start at 0')
+        self.rules.add(r'^arrays start at 1', 'arrays do not start at 1, they start at 0')
+        self.rules.add(r'^felix meow', 'ฅ^•ﻌ•^ฅ')
+        self.rules.add(r'(?P<num>[0-9]+(?:\.[0-9]*)?)\s?(?P<unit>[a-zA-Z°]+)', self.convert_units)
+
+    def cog_unload(self):
+        self.client.message_pipeline.remove_stage('general')
+        self.data_task.cancel()
+
+    @property
+    def http_codes(self):
+        return self.data.get('http_codes')
+
+    @property
+    def http_codes_dog(self):
+        return self.data.get('http_codes_dog')
+
+    @property
+    def chuck_categories(self):
+        return self.data.get('chuck_categories')
 
     # ----------------------------------------------
     # Helper Functions
@@ -75,6 +139,21 @@ class General(commands.Cog, name='General'):
         year_percent = (now - year_start) / (year_end - year_start) * 100
         return f'For your information, the year is {year_percent:.1f}% over!'
 
+    def get_entropy_answer(self, match):
+        if random.random() >= 0.5:
+            return 'the answer I am getting from my entropy is: Yes.'
+        return 'the answer I am getting from my entropy is: No.'
+
+    def convert_units(self, match):
+        n, unit = match.group('num', 'unit')
+        unit = unit.lower()
+        if unit not in UNIT_ALIASES | CONVERSIONS:
+            return None
+        unit = UNIT_ALIASES.get(unit, unit)
+        n = float(n)
+        converter, new = CONVERSIONS[unit]
+        return f'{round(n, 2)} {unit} = {round(converter(n), 2)} {new}'
+
     async def gif_url(self, terms):
         url = (
             f'http://api.giphy.com/v1/gifs/search'
@@ -97,107 +176,13 @@ class General(commands.Cog, name='General'):
         return gif
 
     # ----------------------------------------------
-    # Cog Event listeners
+    # Message pipeline stage
     # ----------------------------------------------
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        # Ignore messages sent by bots
-        if msg.author.bot:
-            return
-
-        # Ignore DM
-        if isinstance(msg.channel, DMChannel):
-            return
-
-        if re.search(r'(?i).*what a twist.*', msg.content):
-            await msg.channel.send('` - directed by M. Night Shyamalan.`')
-
-        if re.search(
-            r'(?i)(?:the|this) (?:current )?year is '
-            + r'(?:almost |basically )?(?:over|done|finished)',
-            msg.content
-        ):
-            await msg.channel.send(self.get_year_string())
-
-        if re.search(
-            r'(?i)send bobs and vagene',
-            msg.content
-        ):
-            await msg.channel.send('😏 *sensible chuckle*')
-
-        if re.search(
-            r'(?i)^(?:hi|what\'s up|yo|hey|hello) felix',
-            msg.content
-        ):
-            await msg.channel.send('hello')
-
-        if re.search(
-            r'(?i)^felix should (?:i|he|she|they|we|<@!?\d+>)',
-            msg.content
-        ):
-            if random.random() >= 0.5:
-                response = 'the answer I am getting from my entropy is: Yes.'
-            else:
-                response = 'the answer I am getting from my entropy is: No.'
-            await msg.channel.send(response)
-
-        if re.search(
-            r'(?i)^html is a programming language',
-            msg.content
-        ):
-            await msg.channel.send('no it\'s not, don\'t be silly')
-
-        if re.search(
-            r'(?i)^you wanna fight, felix\?',
-            msg.content
-        ):
-            await msg.channel.send('bring it on pal (╯°□°）╯︵ ┻━┻')
-
-        if re.search(
-            r'(?i)^arrays start at 0',
-            msg.content
-        ):
-            await msg.channel.send('arrays definitely start at 0')
-
-        if re.search(
-            r'(?i)^arrays start at 1',
-            msg.content
-        ):
-            await msg.channel.send('arrays do not start at 1, they start at 0')
-
-        if re.search(
-            r'(?i)^felix meow',
-            msg.content
-        ):
-            await msg.channel.send('ฅ^•ﻌ•^ฅ')
-
-        if match := self.re_converter.search(msg.content):
-            unit_aliases = {
-                'mile' : 'miles',
-                'kilometer' : 'km',
-                'kilometers' : 'km',
-                'kilometre' : 'km',
-                'kilometres' : 'km',
-                'fahrenheit' : '°f',
-                '°fahrenheit' : '°f',
-                'celsius' : '°c',
-                '°celsius' : '°c',
-            }
-            conversions = {
-                'miles': (lambda x:x*1.609344, 'km'),
-                'km': (lambda x:x*0.6213712, 'miles'),
-                '°f': (lambda x:(x-32)/1.8, '°C'),
-                '°c': (lambda x:x*1.8+32, '°F'),
-                'lb': (lambda x:x*0.4535924, 'kg'),
-                'kg': (lambda x:x*2.204623, 'lb'),
-            }
-            n, unit = match.groups()
-            if unit.lower() not in unit_aliases | conversions:
-                return
-            unit = unit_aliases.get(unit.lower(), unit)
-            n = float(n)
-            converter, new = conversions[unit]
-            await msg.channel.send(f'{round(n, 2)} {unit} = {round(converter(n), 2)} {new}')
+    async def process_message(self, ctx):
+        for responder, match in self.rules.scan(ctx.msg.content):
+            response = responder(match) if callable(responder) else responder
+            if response:
+                await ctx.channel.send(response)
 
     # ----------------------------------------------
     # Cog Commands
@@ -687,7 +672,7 @@ class General(commands.Cog, name='General'):
     async def statuscat(self, ctx, code: int = None):
         """Sends an embed with an image of a cat, portraying the status code.
            If no status code is given it will return a random status cat."""
-        if not hasattr(self, 'http_codes'):
+        if not self.http_codes:
             raise commands.BadArgument('HTTP cats codes not loaded yet')
 
         if code is None:
@@ -708,7 +693,7 @@ class General(commands.Cog, name='General'):
     async def statusdog(self, ctx, code: int = None):
         """Sends an embed with an image of a dog, portraying the status code.
            If no status code is given it will return a random status dog."""
-        if not hasattr(self, 'http_codes_dog'):
+        if not self.http_codes_dog:
             raise commands.BadArgument('HTTP dogs codes not loaded yet')
 
         if code is None:
@@ -729,7 +714,7 @@ class General(commands.Cog, name='General'):
     async def chucknorris(self, ctx, category: str = None):
         """ Collects a random chuck norris joke, or collect a random joke
             by specifying a specific category of joke. """
-        if not hasattr(self, 'chuck_categories'):
+        if not self.chuck_categories:
             raise commands.BadArgument('Hold up partner, still locating Chuck!')
 
         if category is None:
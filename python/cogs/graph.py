@@ -1,20 +1,41 @@
 """This is a cog for a discord.py bot.
 It adds commands to print graphs of user message stats
 
+The data comes from the local message statistics (client.message_stats),
+which are collected by the chatlog cog.
+
 Commands:
     graph       print help message
     ├ users     print graph containing specific users
-    └ top       print graph containing most active users
+    ├ top       print graph containing most active users
+    └ server    print graph of the server message activity
+
+The graphs are rendered in a separate process (see utils/render.py)
+so rendering does not block the bot.
+Rendered graphs are cached per command, parameters and hour. Messages of the
+current day are counted within the hour, new messages of older days drop
+the cache.
 
 This cog requires matplotlib:
     pip install -U matplotlib
 
 Only users that have an admin role can use the commands.
 """
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from io import BytesIO
 from discord.ext import commands
 from discord import Member, File
-import matplotlib.pyplot as plt
+from utils.cache import LRUCache
+from utils.render import render_messages_graph, render_server_graph
+
+# Maximum number of graphs that are rendered at the same time
+RENDER_PROCESSES = 2
+# Maximum number of rendered graphs that are cached
+RENDER_CACHE_SIZE = 32
+# Cached graphs are valid for the current time bucket of
+RENDER_CACHE_BUCKET = 3600  # Seconds
 
 
 def clamp(value: int, low: int, high: int):
@@ -30,96 +51,71 @@ class Graph(commands.Cog,
             command_attrs=dict(hidden=False)):
     def __init__(self, client):
         self.client = client
+        # spawn: forking the bot while one of its threads holds a lock can
+        # deadlock the worker. The workers import bot.py without starting the bot.
+        self.render_pool = ProcessPoolExecutor(
+            max_workers=RENDER_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        # Key: (command, parameters..., time bucket) | Value: PNG bytes
+        self.render_cache = LRUCache(RENDER_CACHE_SIZE)
+        self.client.message_stats.add_listener(self.on_new_stats)
 
     async def cog_check(self, ctx):
         return self.client.user_is_admin(ctx.author)
 
+    def cog_unload(self):
+        self.client.message_stats.remove_listener(self.on_new_stats)
+        self.render_pool.shutdown(wait=False)
+
+    def on_new_stats(self, days):
+        """Drop cached graphs if messages for a day before today were added"""
+        today = datetime.utcnow().date().isoformat()
+        if any(day < today for day in days):
+            self.render_cache.clear()
+
+    @staticmethod
+    def cache_key(*args):
+        return (*args, int(datetime.utcnow().timestamp() // RENDER_CACHE_BUCKET))
+
+    @staticmethod
+    def to_file(png):
+        return File(BytesIO(png), filename='graph.png')
+
+    async def render(self, func, *args):
+        """Render a graph in the render pool and return the PNG bytes"""
+        return await self.client.loop.run_in_executor(self.render_pool, func, *args)
+
     async def create_graph_messages(self, days, limit=0, users=None):
-        url = 'https://emkc.org/api/v1/stats/discord/messages'
-        if not users:
-            # gets the top people of days and puts them in user_names
-            params = {
-                'start': (datetime.utcnow() - timedelta(days=days)).isoformat(),
-                'limit': limit
-            }
-            async with self.client.session.get(url, params=params) as response:
-                if response.status != 200:
-                    return False
-                api_data = await response.json()
-            if not api_data:
-                return False
-            user_names = {data['user']: data['discord_id']
-                          for data in api_data}
-            num_messages = {data['user']: data['messages']
-                            for data in api_data}
-        else:
-            # puts specific people in user_names
-            user_ids = [user.id for user in users]
-            params = [(
-                'start',
-                (datetime.utcnow() - timedelta(days=days)).isoformat()
-            )]
-            params += [('discord_id', user_id) for user_id in user_ids]
-            async with self.client.session.get(url, params=params) as response:
-                if response.status != 200:
-                    return False
-                api_data = await response.json()
-            if not api_data:
-                return False
-
-            unsorted_names = {data['user']: data['discord_id']
-                              for data in api_data}
-            num_messages = {data['user']: data['messages']
-                            for data in api_data}
-            user_names = dict()
-            for key, value in sorted(
-                unsorted_names.items(),
-                key=lambda x: num_messages[x[0]],
-                reverse=True
-            ):
-                user_names[key] = value
-
-        graph_data = {name: [[0, 0]] for name in user_names}
-        for i in range(days):
-            startdate = datetime.utcnow() - timedelta(days=days - i)
-            enddate = datetime.utcnow() - timedelta(days=days - i - 1)
-            params = [('start', (startdate).isoformat()),
-                      ('end', (enddate).isoformat())]
-            params += [('discord_id', uid) for uid in user_names.values()]
-            async with self.client.session.get(url, params=params) as response:
-                if response.status != 200:
-                    return False
-                api_data = await response.json()
-            retrieved_users = {x['user']: x for x in api_data}
-            for username, data in graph_data.items():
-                if data:
-                    current_msg = data[-1][1]
-                else:
-                    current_msg = 0
-                if username not in retrieved_users:
-                    new_messages = current_msg
-                else:
-                    api_data = retrieved_users[username]
-                    new_messages = current_msg + api_data['messages']
-                data.append([i+1, new_messages])
-        if all([not x for x in graph_data.values()]):
-            return False
-        for name, data in graph_data.items():
-            xaxis = [i[0] for i in data]
-            yaxis = [i[1] for i in data]
-            templabel = '{} {}'.format(name[:-5], num_messages[name])
-            plt.plot(xaxis, yaxis, label=templabel, marker='o', markersize=3)
-        plt.legend()
-        plt.ylabel('Messages')
-        label_time = (datetime.utcnow() - timedelta(days=days)).isoformat()
-        plt.xlabel(
-            'Time in days since '
-            f'{label_time.split(".")[0].replace("T", " ")}'
-            ' UTC'
+        """Return the PNG of the message graph or None if there is no data"""
+        stats = self.client.message_stats
+        # Make sure messages that are still buffered are counted
+        await stats.flush()
+        user_ids = sorted(user.id for user in users) if users else None
+        key = self.cache_key('messages', days, limit, tuple(user_ids or ()))
+        if key in self.render_cache:
+            return self.render_cache.get(key)
+        today = datetime.utcnow().date()
+        day_list = [(today - timedelta(days=days - i - 1)).isoformat() for i in range(days)]
+        top_users = await stats.top_users(day_list[0], day_list[-1], limit, user_ids)
+        if not top_users:
+            return None
+        daily = await stats.daily_user_counts(
+            day_list[0], day_list[-1], [user_id for user_id, _, _ in top_users]
         )
-        plt.savefig('last_graph.png', bbox_inches='tight')
-        plt.cla()
-        return True
+        series = []
+        for user_id, name, total in top_users:
+            xaxis = [0]
+            yaxis = [0]
+            for i, day in enumerate(day_list):
+                xaxis.append(i + 1)
+                yaxis.append(yaxis[-1] + daily[user_id].get(day, 0))
+            templabel = '{} {}'.format(name.rsplit('#', 1)[0], total)
+            series.append((templabel, xaxis, yaxis))
+        xlabel = f'Time in days since {day_list[0]} 00:00:00 UTC'
+        png = await self.render(render_messages_graph, series, xlabel)
+        self.render_cache.set(key, png)
+        return png
 
     # ----------------------------------------------
     # Cog Commands
@@ -148,10 +144,9 @@ class Graph(commands.Cog,
         await ctx.trigger_typing()
         days = clamp(days, 1, 30)
         n = clamp(n, 1, 10)
-        if await self.create_graph_messages(days, n):
-            with open('last_graph.png', 'rb') as g:
-                file_to_send = File(g)
-            await ctx.send(file=file_to_send)
+        png = await self.create_graph_messages(days, n)
+        if png:
+            await ctx.send(file=self.to_file(png))
         else:
             await ctx.send('Nothing found')
 
@@ -171,10 +166,9 @@ class Graph(commands.Cog,
             raise commands.BadArgument('Please specify at least 1 member')
         await ctx.trigger_typing()
         days = clamp(days, 1, 30)
-        if await self.create_graph_messages(days, 0, members[:10]):
-            with open('last_graph.png', 'rb') as g:
-                file_to_send = File(g)
-            await ctx.send(file=file_to_send)
+        png = await self.create_graph_messages(days, 0, members[:10])
+        if png:
+            await ctx.send(file=self.to_file(png))
         else:
             await ctx.send('Nothing found')
 
@@ -190,44 +184,32 @@ class Graph(commands.Cog,
         """Print server message activity graph
         Each plot point shows the number of messages since the previous one"""
         await ctx.trigger_typing()
-        url = 'https://emkc.org/api/v1/stats/discord/messages'
+        stats = self.client.message_stats
+        await stats.flush()
+        key = self.cache_key('server', num_samples, sample_distance)
+        if key in self.render_cache:
+            await ctx.send(file=self.to_file(self.render_cache.get(key)))
+            return
+        today = datetime.utcnow().date()
+        first_day = today - timedelta(days=num_samples * sample_distance - 1)
+        daily = await stats.daily_counts(first_day.isoformat(), today.isoformat())
+        if not daily:
+            await ctx.send('Nothing found')
+            return
         num_messages = []
         for w in range(num_samples):
-            start = (datetime.utcnow() -
-                     timedelta(days=(w+1)*sample_distance))
-            end = (datetime.utcnow() -
-                   timedelta(days=(w)*sample_distance))
-            params = {
-                'start': start.isoformat(),
-                'end': end.isoformat()
-            }
-            async with self.client.session.get(url, params=params) as response:
-                if response.status != 200:
-                    return False
-                api_data = await response.json()
-            if not api_data:
-                return False
+            end = today - timedelta(days=w * sample_distance)
+            window = [end - timedelta(days=d) for d in range(sample_distance)]
             num_messages.append(
                 (end.strftime('%b %d'),
-                 sum(data['messages'] for data in api_data))
+                 sum(daily.get(day.isoformat(), 0) for day in window))
             )
         num_messages.reverse()
         values_x = [i[0] for i in num_messages]
         values_y = [i[1] for i in num_messages]
-        fig, ax = plt.subplots()
-        ax.plot(values_x, values_y, marker='o', markersize=3)
-        ax.set_ylabel('Messages')
-        ax.set_xlabel('Date')
-        ax.set_ylim(ymin=0)
-        ax.grid(True)
-        labels = ax.get_xticklabels()
-        plt.setp(labels, rotation=90)
-        fig.savefig('last_graph.png', bbox_inches='tight')
-        fig.clear()
-
-        with open('last_graph.png', 'rb') as g:
-            file_to_send = File(g)
-        await ctx.send(file=file_to_send)
+        png = await self.render(render_server_graph, values_x, values_y)
+        self.render_cache.set(key, png)
+        await ctx.send(file=self.to_file(png))
 
 
 def setup(client):
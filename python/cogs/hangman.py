@@ -134,6 +134,10 @@ class Hangman(commands.Cog):
         # A dict which stores currently active games
         # Key: user_id | Value: HangmanGame instance
         self.active_games = {}
+        self.client.message_pipeline.add_stage('hangman', self.process_message, 40)
+
+    def cog_unload(self):
+        self.client.message_pipeline.remove_stage('hangman')
 
     async def get_words(self, amount=100):
         async with self.client.session.get(
@@ -144,16 +148,17 @@ class Hangman(commands.Cog):
         words = random.sample(text.split(), 200)
         return [i.strip() for i in words if len(i) >= MIN_LENGTH]
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
+    async def process_message(self, ctx):
+        """Handle guesses - a guess is deleted and not passed on to later stages"""
+        message = ctx.msg
         # A hacky way to detect if user is typing a command
         if ' ' in message.content:
-            return
+            return False
         _id = message.author.id
         game = self.active_games.get(_id)
         if game:
             if game.channel.id != message.channel.id:
-                return
+                return False
             if game.last_bot_message:
                 await game.last_bot_message.delete()
                 game.last_bot_message = None
@@ -164,6 +169,8 @@ class Hangman(commands.Cog):
             game.last_user_message = message
             if game.is_complete:
                 del self.active_games[_id]
+            return True
+        return False
 
     @commands.command(
         name="hangman"
@@ -15,12 +15,15 @@ Commands:
 Only users that have an admin role can use the commands.
 """
 
-import json
+import asyncio
+import re
 import time
-from collections import deque
+from datetime import datetime
 from dataclasses import dataclass, field
 from discord.ext import commands, tasks
-from discord import Member, DMChannel, Embed, NotFound, VerificationLevel
+from discord import Member, Embed, NotFound, HTTPException, VerificationLevel
+from utils.spam import SpamDetector, DuplicateDetector, JoinFloodMonitor
+from utils.ttl import TTLMap
 #pylint: disable=E1101
 
 
@@ -29,21 +32,53 @@ from discord import Member, DMChannel, Embed, NotFound, VerificationLevel
 SPAM_NUM_MSG = 7  # Messages
 # Within
 SPAM_TIME = 10  # Seconds
+# (both can be changed with "spam_num_msg" and "spam_time" in the config,
+# channels with their own limits can be set with "spam_channel_limits":
+# {"<channel id>": [<messages>, <seconds>]})
+# Message histories are kept for at most
+SPAM_MAX_USERS = 100_000  # Users
 # If a user receives a second warning within
 SPAM_NAUGHTY_DURATION = 900  # Seconds
 # he will be permanently jailed
-# The task that clears the history and removes users from the "watchlist" if
+# The task that removes users from the "watchlist" if
 # they have been on it for more than SPAM_NAUGHTY_DURATION will run every
 SPAM_NAUGHTY_CHECK_INTERVAL = 300  # seconds
-# Staff will recieve a warning if more than
-FLOOD_JOIN_NUM = 10  # Users join
+# Users will be jailed if they post the same message in
+DUPLICATE_CHANNELS = 4  # Channels
+# Staff will receive a report if the same message is posted by
+DUPLICATE_ACCOUNTS = 4  # Users
 # Within
-FLOOD_JOIN_TIME = 10  # Seconds
+DUPLICATE_WINDOW = 300  # Seconds
+# Shorter messages (without spaces and punctuation) are not compared
+DUPLICATE_MIN_LENGTH = 20  # Characters
+# Only members with a suspicion score or that joined within this time count
+# towards DUPLICATE_ACCOUNTS - established members may say the same thing
+DUPLICATE_NEW_MEMBER = 86400  # Seconds
+# Staff will recieve a warning if within one of these windows
+# (Seconds, Users join, with a suspicion score of at least)
+FLOOD_WINDOWS = [
+    (10, 10, 0),
+    (60, 30, 1),
+    (600, 100, 2),
+]
+# (can be changed with "flood_windows" in the config)
+# Suspicion score: accounts younger than 1 day +2, younger than 7 days +1,
+# default avatar +1, name matching FLOOD_SUSPICIOUS_NAME +1
+FLOOD_SUSPICIOUS_NAME = re.compile(r'\d{4,}$')
+# Suspected flooders are forgotten after
+FLOOD_SUSPECT_TTL = 3600  # Seconds
+# At most this many suspected flooders are kept
+FLOOD_MAX_SUSPECTS = 5000
 # And the servers verification level will be changed to
 # available options: none, medium, high, extreme
 FLOOD_VERIFICATION_LEVEL = VerificationLevel.extreme
 # The default verification level is
 DEFAULT_VERIFICATION_LEVEL = VerificationLevel.medium
+# When jailing many users at once this many role changes run at the same time
+# (discord.py waits for the route rate limits by itself)
+BULK_JAIL_WORKERS = 8
+# The progress message of a bulk jail is updated every
+BULK_JAIL_PROGRESS_INTERVAL = 2  # Seconds
 
 
 @dataclass
@@ -60,19 +95,34 @@ class Jail(commands.Cog, name='Jail'):
         self.JAIL_CHANNEL_ID = self.client.config['jail_channel']
         self.REPORT_ROLE = self.client.config['report_role']
         self.TEAM_ROLE = self.client.config['team_role']
-        # Dict to store offenders
-        self.naughty = {}
-        # Dict to store the timestamps of each users last 10 messages
-        self.history = {}
-        self.member_history = deque(
-            [(time.time() - FLOOD_JOIN_TIME, None)] * FLOOD_JOIN_NUM,
-            FLOOD_JOIN_NUM
+        # Dict to store offenders - persisted so a restart does not reset warnings
+        self.naughty = self.client.state.get('spam_naughty', {})
+        # Set of perma-jailed member ids - changes are written to the state incrementally
+        self.perma_jail = self.client.state.members('jailed')
+        config = self.client.config
+        self.spam_detector = SpamDetector(
+            config.get('spam_num_msg', SPAM_NUM_MSG),
+            config.get('spam_time', SPAM_TIME),
+            channel_limits={
+                int(channel_id): tuple(limits)
+                for channel_id, limits in config.get('spam_channel_limits', {}).items()
+            },
+            max_users=SPAM_MAX_USERS
         )
-        self.suspected_flooders = set()
+        self.duplicate_detector = DuplicateDetector(
+            DUPLICATE_WINDOW,
+            DUPLICATE_CHANNELS,
+            DUPLICATE_ACCOUNTS,
+            min_length=DUPLICATE_MIN_LENGTH
+        )
+        self.flood_monitor = JoinFloodMonitor(config.get('flood_windows', FLOOD_WINDOWS))
+        # Key: member id | Value: name of the member
+        self.suspected_flooders = TTLMap(FLOOD_SUSPECT_TTL, maxsize=FLOOD_MAX_SUSPECTS)
         # Task that will remove users from the naughty list if they behaved for
-        # 15 minutes - will also clear self.history to not let it get too big
+        # 15 minutes - will also drop the message histories of idle users
         self.clear_naughty_list.start()
         self.acceptance_pending = dict()
+        self.client.message_pipeline.add_stage('jail', self.process_message, 10, bots=True)
 
     async def cog_check(self, ctx):
         return self.client.user_is_admin(ctx.author)
@@ -80,11 +130,37 @@ class Jail(commands.Cog, name='Jail'):
     # ----------------------------------------------
     # Helper Functions
     # ----------------------------------------------
-    async def report_flood(self):
+    def suspicion_score(self, member):
+        """Return how much a joining account looks like a raid account"""
+        score = 0
+        age = (datetime.utcnow() - member.created_at).total_seconds()
+        if age < 86400:
+            score += 2
+        elif age < 7 * 86400:
+            score += 1
+        if member.avatar is None:
+            score += 1
+        if FLOOD_SUSPICIOUS_NAME.search(member.name):
+            score += 1
+        return score
+
+    def may_be_raider(self, member):
+        """Return True if member is suspicious or joined recently"""
+        if self.suspicion_score(member) > 0:
+            return True
+        joined_at = getattr(member, 'joined_at', None)
+        if joined_at is None:
+            return False
+        return (datetime.utcnow() - joined_at).total_seconds() < DUPLICATE_NEW_MEMBER
+
+    def add_suspects(self, members):
+        for member in members:
+            self.suspected_flooders.set(member.id, str(member))
+
+    async def report_flood(self, window='Many users joined'):
         target = self.client.get_channel(self.REPORT_CHANNEL_ID)
         description = (
-            f'More than {FLOOD_JOIN_NUM} users joined within {FLOOD_JOIN_TIME} '
-            'seconds.\n**I have disabled welcome messages and set the verification '
+            f'{window}.\n**I have disabled welcome messages and set the verification '
             f'level to "highest"**.\n'
             'Options:\n • `felix flood list` to see the usernames\n'
             '• `felix flood clear` to clear the list, enable welcome messages '
@@ -109,19 +185,17 @@ class Jail(commands.Cog, name='Jail'):
         )
         self.client.flood_mode = False
 
-    def load_state(self):
-        with open("../state.json", "r") as statefile:
-            return json.load(statefile)
+    def add_perma_jail(self, member_ids):
+        new = set(member_ids) - self.perma_jail
+        if new:
+            self.perma_jail.update(new)
+            self.client.state.add_members('jailed', new)
 
-    def load_perma_jail(self):
-        state = self.load_state()
-        return state.get('jailed', [])
-
-    def save_perma_jail(self, perma_jail):
-        state = self.load_state()
-        state['jailed'] = perma_jail
-        with open("../state.json", "w") as statefile:
-            return json.dump(state, statefile, indent=1)
+    def remove_perma_jail(self, member_ids):
+        removed = self.perma_jail.intersection(member_ids)
+        if removed:
+            self.perma_jail.difference_update(removed)
+            self.client.state.remove_members('jailed', removed)
 
     async def send_to_jail(self, member, reason=None, permanent=True):
         """Jail a user
@@ -133,7 +207,7 @@ class Jail(commands.Cog, name='Jail'):
             reason {string} -- The Reason that will show in the
                                Audit Log (default: {None})
             permanent {bool} -- Add the users id to the
-                                state.json (default: {True})
+                                bot state (default: {True})
 
         Returns:
             str -- Status message
@@ -146,14 +220,57 @@ class Jail(commands.Cog, name='Jail'):
         except NotFound:
             status = f'{member} not in guild'
         if permanent:
-            perma_jail = self.load_perma_jail()
-            if member.id not in perma_jail:
-                perma_jail.append(member.id)
-                self.save_perma_jail(perma_jail)
+            if member.id not in self.perma_jail:
+                self.add_perma_jail([member.id])
             else:
                 status = f'{member} is already jailed'
         return status
 
+    async def jail_members(self, members, reason=None, progress_msg=None):
+        """Jail many users concurrently and add them to the perma-jail set once
+
+        Arguments:
+            members {list} -- The Members to jail
+
+        Keyword Arguments:
+            reason {string} -- The Reason that will show in the
+                               Audit Log (default: {None})
+            progress_msg {discord.Message} -- Message that is edited to
+                                              show the progress (default: {None})
+
+        Returns:
+            list -- Status message for each member
+        """
+        semaphore = asyncio.Semaphore(BULK_JAIL_WORKERS)
+        # Ids of the members that were jailed (or left the guild) - only these are persisted
+        jailed = []
+
+        async def worker(member):
+            async with semaphore:
+                try:
+                    status = await self.send_to_jail(member, reason=reason, permanent=False)
+                except HTTPException as e:
+                    return f'{member} could not be jailed ({e.status})'
+            if member.id in self.perma_jail:
+                return f'{member} is already jailed'
+            jailed.append(member.id)
+            return status
+
+        jobs = [asyncio.ensure_future(worker(member)) for member in members]
+        pending = jobs
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=BULK_JAIL_PROGRESS_INTERVAL)
+            if progress_msg is not None:
+                done = len(jobs) - len(pending)
+                await progress_msg.edit(content=f'`Jailing users: {done}/{len(jobs)}`')
+        self.add_perma_jail(jailed)
+        return [job.result() for job in jobs]
+
+    async def send_results(self, ctx, results):
+        """Send a list of status messages - packed into as few messages as possible"""
+        if results:
+            await self.client.outbox.send_block(ctx.channel, results)
+
     async def release_from_jail(self, member):
         """Un-Jail a user
 
@@ -164,92 +281,128 @@ class Jail(commands.Cog, name='Jail'):
             str -- Status message
         """
         status = f'{member} successfully released'
-        perma_jail = self.load_perma_jail()
         get_role = member.guild.get_role
         jail_roles = [get_role(x) for x in self.jail_roles if get_role(x)]
         await member.remove_roles(*jail_roles)
-        if member.id in perma_jail:
-            perma_jail.remove(member.id)
-            self.save_perma_jail(perma_jail)
+        if member.id in self.perma_jail:
+            self.remove_perma_jail([member.id])
         else:
             status = f'{member} is not in jail'
         return status
 
-    async def post_report(self, msg):
+    async def post_report(self, msg, reason='spammed in'):
         """Post report of auto jailing to report channel"""
         target = self.client.get_channel(self.REPORT_CHANNEL_ID)
         await target.send(
             f'<@&{self.REPORT_ROLE}> I jailed a user\n'
-            f'User {msg.author.mention} spammed in {msg.channel.mention}'
+            f'User {msg.author.mention} {reason} {msg.channel.mention}'
         )
         return True
 
+    async def report_duplicates(self, msg, user_ids):
+        """Report accounts that posted the same message and add them to the
+        suspected flooders"""
+        members = [m for m in map(msg.guild.get_member, user_ids) if m is not None]
+        self.add_suspects(members)
+        target = self.client.get_channel(self.REPORT_CHANNEL_ID)
+        mentions = ' '.join(m.mention for m in members)
+        embed = Embed(description=msg.content[:2000], color=0xFF0000)
+        await target.send(
+            f'<@&{self.REPORT_ROLE}> These users posted the same message '
+            f'(last in {msg.channel.mention}):\n{mentions}\n'
+            'They have been added to the suspected flooders (`felix flood list`)',
+            embed=embed
+        )
+
     # ----------------------------------------------
-    # Cog Event listeners
+    # Message pipeline stage
     # ----------------------------------------------
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        member = msg.author
-        if member == self.client.user:
+    async def process_message(self, ctx):
+        if ctx.is_self:
             # Don't run on the bots own messages
-            return
-        if isinstance(msg.channel, DMChannel):
-            # Ignore DM
-            return
-        now = time.time()
+            return False
+        msg = ctx.msg
+        member = msg.author
+        if not ctx.is_admin and not ctx.is_bot:
+            cross_channel, accounts, first_report = self.duplicate_detector.hit(
+                member.id, msg.channel.id, msg.content,
+                count_account=self.may_be_raider(member)
+            )
+            if first_report:
+                await self.report_duplicates(msg, accounts)
+            elif accounts:
+                # The message was reported already - don't ping again
+                self.add_suspects(
+                    m for m in map(msg.guild.get_member, accounts) if m is not None
+                )
+            if cross_channel:
+                await self.warn_or_jail(
+                    msg,
+                    'posting the same message in many channels',
+                    reason='Cross channel spam',
+                    report_reason='posted the same message in many channels, last in'
+                )
+                return False
+        # The detector resets the users history when the limit is exceeded
+        # so he doesn't get jailed immediately on the next message
+        if not self.spam_detector.hit(member.id, msg.channel.id):
+            return False
+        await self.warn_or_jail(msg, 'sending too many messages', reason='Excessive messaging')
+        return False
+
+    async def warn_or_jail(self, msg, warning, reason, report_reason='spammed in'):
+        """Warn the author of msg and add him to the naughty list - or jail
+        him if he is on the naughty list already"""
+        member = msg.author
         uid = str(member.id)
-        user_history = self.history.get(uid, deque())
-        # Add timestamp of current message to list of known timestamps of user
-        user_history.append(now)
-        if len(user_history) == SPAM_NUM_MSG:
-            # When we know enough message timestamps (SPAM_NUM_MSG)
-            # Pop the oldest message
-            oldest = user_history.popleft()
-            if now - oldest < SPAM_TIME:
-                # If the oldest message was sent less than SPAM_TIME seconds ago
-                if uid in self.naughty:
-                    # Jail the user permanently
-                    # If he is already on the naughty list
-                    await self.send_to_jail(member,
-                                            reason='Excessive messaging')
-                    await msg.channel.send("Aaaand it's gone")
-                    await self.post_report(msg)
-                else:
-                    # Warn the user and add him to the naughty list
-                    # If he is not on the naughty list yet
-                    await msg.channel.send(
-                        f'Hey {member.mention}, you are sending too many '
-                        + 'messages. This is a warning! If you keep '
-                        + 'this up you will be jailed.'
-                    )
-                    self.naughty[uid] = now
-                    # "Reset" his history so he doesn't get jailed immediately
-                    # on the 11th message
-                    user_history = []
-        # Save the users history again (the oldest message was popped)
-        self.history[uid] = user_history
+        if uid in self.naughty:
+            # Jail the user permanently
+            # If he is already on the naughty list
+            await self.send_to_jail(member, reason=reason)
+            await msg.channel.send("Aaaand it's gone")
+            await self.post_report(msg, report_reason)
+        else:
+            # Warn the user and add him to the naughty list
+            # If he is not on the naughty list yet
+            await msg.channel.send(
+                f'Hey {member.mention}, you are {warning}. '
+                + 'This is a warning! If you keep '
+                + 'this up you will be jailed.'
+            )
+            self.naughty[uid] = time.time()
+            self.client.state.set('spam_naughty', self.naughty)
+
+    # ----------------------------------------------
+    # Cog Event listeners
+    # ----------------------------------------------
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
         """Checks if a joining user is "perma-jailed"
         and jails him if needed
         """
-        perma_jail = self.load_perma_jail()
-        if member.id in perma_jail:
+        if member.id in self.perma_jail:
             await self.send_to_jail(
                 member, reason='User tried to rejoin', permanent=False
             )
 
         # Flood Protection
-        now = time.time()
-        self.member_history.append((now, member))
-        if (now - self.member_history[0][0]) < FLOOD_JOIN_TIME:
-            self.suspected_flooders.update(
-                member for _, member in self.member_history
+        score = self.suspicion_score(member)
+        tripped, newly_tripped = self.flood_monitor.add(member.id, score)
+        if not tripped:
+            return
+        # The recent joins are only walked when a window trips - after that
+        # only the joining member is added
+        for window in newly_tripped:
+            self.add_suspects(
+                m for m in map(member.guild.get_member, self.flood_monitor.suspects(window))
+                if m is not None
             )
-            if not self.client.flood_mode:
-                await self.report_flood()
-                await self.enable_flood_mode()
+        if any(score >= window.min_score for window in tripped):
+            self.add_suspects([member])
+        if not self.client.flood_mode:
+            await self.report_flood(str(tripped[0]))
+            await self.enable_flood_mode()
 
     @commands.Cog.listener()
     async def on_reaction_add(self, reaction, user):
@@ -302,11 +455,8 @@ class Jail(commands.Cog, name='Jail'):
         """Show a list of suspected flooders"""
         if not self.suspected_flooders:
             return await ctx.send('List is empty.')
-        members = [str(m) for m in self.suspected_flooders]
-        # Print 50 members at a time
-        for page in range(len(members) // 50 + 1):
-            to_print = '\n'.join(members[page*50:(page+1)*50])
-            await ctx.send(f'```\n{to_print}\n```')
+        members = [name for _, name in self.suspected_flooders.items()]
+        await self.client.outbox.send_block(ctx.channel, members)
 
     @flood.command(
         name='clear',
@@ -318,23 +468,31 @@ class Jail(commands.Cog, name='Jail'):
         await self.disable_flood_mode()
         await ctx.send('`Cleared`')
 
-    # @flood.command(
-    #     name='jailall',
-    # )
-    # async def flood_jailall(self, ctx):
-    #     """Jails all members in the reported member set"""
-    #     if not self.suspected_flooders:
-    #         return await ctx.send('No members to jail.')
-    #     await ctx.send(f'`Jailing {len(self.suspected_flooders)} users (might take a while)`')
-    #     jailed = []
-    #     for i in self.suspected_flooders:
-    #         status = await self.send_to_jail(i, reason='Server flooding')
-    #         jailed.append(status)
-
-    #     # Print 20 jail confirmations at a time
-    #     for page in range(len(jailed) // 20 + 1):
-    #         to_print = '\n'.join(jailed[page*20:(page+1)*20])
-    #         await ctx.send(f'```\n{to_print}\n```')
+    @flood.command(
+        name='jailall',
+    )
+    async def flood_jailall(self, ctx):
+        """Jails all members in the reported member set"""
+        suspects = self.suspected_flooders.items()
+        if not suspects:
+            return await ctx.send('No members to jail.')
+        members = []
+        jailed = []
+        gone = []
+        for member_id, name in suspects:
+            member = ctx.guild.get_member(member_id)
+            if member is None:
+                # Left already - will be jailed if he comes back
+                gone.append(member_id)
+                jailed.append(f'{name} not in guild')
+            elif not self.client.user_is_admin(member):
+                members.append(member)
+        self.add_perma_jail(gone)
+        progress_msg = await ctx.send(f'`Jailing {len(members)} users`')
+        jailed += await self.jail_members(
+            members, reason='Server flooding', progress_msg=progress_msg
+        )
+        await self.send_results(ctx, jailed)
 
     @flood.command(
         name='simulate'
@@ -354,15 +512,20 @@ class Jail(commands.Cog, name='Jail'):
         if not members:
             raise commands.BadArgument('Please specify at least 1 member')
         results = []
+        to_jail = []
         for member in members:
             if member == self.client.user:
                 results.append('I refuse to jail myself')
             elif self.client.user_is_admin(member):
                 results.append(f'Sorry, {member} is my friend')
-            else:
-                r = await self.send_to_jail(member)
-                results.append(r)
-        await ctx.send('```\n'+'\n'.join(results)+'```')
+            elif member not in to_jail:
+                to_jail.append(member)
+        if to_jail:
+            progress_msg = None
+            if len(to_jail) > BULK_JAIL_WORKERS:
+                progress_msg = await ctx.send(f'`Jailing {len(to_jail)} users`')
+            results += await self.jail_members(to_jail, progress_msg=progress_msg)
+        await self.send_results(ctx, results)
 
     @commands.command(
         name='unjail',
@@ -412,8 +575,12 @@ class Jail(commands.Cog, name='Jail'):
         for k, v in self.naughty.items():
             if now - v < SPAM_NAUGHTY_DURATION:
                 newdict[k] = v
+        if len(newdict) != len(self.naughty):
+            self.client.state.set('spam_naughty', newdict)
         self.naughty = newdict
-        self.history = {}
+        self.spam_detector.expire()
+        self.duplicate_detector.expire()
+        self.suspected_flooders.expire()
 
         if self.client.flood_mode:
             target = self.client.get_channel(self.REPORT_CHANNEL_ID)
@@ -424,6 +591,7 @@ class Jail(commands.Cog, name='Jail'):
 
     def cog_unload(self):
         self.clear_naughty_list.cancel()
+        self.client.message_pipeline.remove_stage('jail')
 
 
 def setup(client):
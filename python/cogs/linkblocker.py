@@ -3,28 +3,52 @@ It will auto delete messages that contain certain links.
 Discord invite link offenders will be informed 1 time every 10 minutes.
 patreon and gofundme links are silently deleted
 
+The forbidden domains and file types are loaded from the bot state
+("link_policy") or, if they were never changed by command, from "link_policy"
+in the config (see utils/linkpolicy.py).
+
 Commands:
     allow           Specify a user. User is then allowed to post 1
                     discord.gg invite link
+    linkpolicy      show the link policy
+    ├ add           add a forbidden domain, allowed domain or forbidden file type
+    ├ remove        remove a forbidden domain, allowed domain or forbidden file type
+    ├ import        add the forbidden domains of a list (attached file or url)
+    ├ reload        reload the link policy from the state and config.json
+    ├ reset         discard changes made by command and use config.json
+    ├ badfiles      show the number of known bad attachments
+    └ forget        remove a known bad attachment by its sha256
+
+Attachments that were quarantined once are blocked when they are uploaded
+again, even under a name with an allowed file type (see utils/quarantine.py).
 
 Only users that have an admin role can use the commands.
 """
 
-import re
+import asyncio
+import json
 import time
 import random
-from dataclasses import dataclass
-from io import BytesIO
-from discord.ext import commands
-from discord import Member, DMChannel, Embed, File
+from dataclasses import dataclass, field
+from discord.ext import commands, tasks
+from discord import Member, DMChannel, Embed
 from discord.abc import Messageable
+from aiohttp import ClientError
+from utils.linkpolicy import LinkPolicy, RULE_KINDS, parse_domain_list
+from utils.quarantine import quarantine, fetch_prefix_hash, KnownBadFiles, QuarantinedFile
+from utils.ttl import TTLMap
+
+# Invite link offenders are only informed once within
+NAUGHTY_LIST_TIME = 600  # Seconds
+# Expired offenders are removed every
+NAUGHTY_LIST_SWEEP_INTERVAL = 300  # Seconds
+# Keep the offenders in the bot state, so a restart does not reset them
+NAUGHTY_LIST_PERSIST = True
 
-FORBIDDEN = [
-    'patreon.com',
-    'gofundme.com',
-    'gofund.me'
-]
-FORBIDDEN_FILETYPES = ('.exe',)
+# Forbidden attachments up to this size are downloaded and attached to the report
+QUARANTINE_MAX_SIZE = 8_000_000  # Bytes
+# Maximum number of attachments downloaded at the same time
+QUARANTINE_CONCURRENCY = 3
 
 
 @dataclass
@@ -33,21 +57,71 @@ class MinimalMessage:
     author: Member
     channel: Messageable
     attachments: list
+    # QuarantinedFile for each forbidden attachment
+    quarantined: list = field(default_factory=list)
 
 
 class LinkBlocker(commands.Cog, name='Link Blocker'):
     def __init__(self, client):
         self.client = client
-        self.allowed_once = []
-        self.naughty_list = {}
-        self.NAUGHTY_LIST_TIME = 600
+        # Ids of users that may post 1 invite link
+        self.allowed_once = set()
+        # Key: user id | Value: time of the offense
+        self.naughty_list = TTLMap(NAUGHTY_LIST_TIME, clock=time.time)
+        self.load_naughty_list()
+        self.sweep_naughty_list.start()
         self.REPORT_CHANNEL = self.client.config['report_channel']
         self.REPORT_ROLE = self.client.config['report_role']
-        self.forbidden_files = []
+        self.download_semaphore = asyncio.Semaphore(QUARANTINE_CONCURRENCY)
+        self.known_bad_files = KnownBadFiles(self.client.state)
+        self.policy = self.load_policy()
+        self.client.message_pipeline.add_stage(
+            'linkblocker', self.process_message, 20, bots=True
+        )
 
     async def cog_check(self, ctx):
         return self.client.user_is_admin(ctx.author)
 
+    # ----------------------------------------------
+    # Invite link offenders
+    # ----------------------------------------------
+    def load_naughty_list(self):
+        if not NAUGHTY_LIST_PERSIST:
+            return
+        now = time.time()
+        offenders = self.client.state.get('link_naughty', {})
+        # Oldest first - the TTLMap has to be filled in order.
+        # Restored offenders keep the window of their offense.
+        for user_id, offense in sorted(offenders.items(), key=lambda item: item[1]):
+            if now - offense < NAUGHTY_LIST_TIME:
+                self.naughty_list.set(int(user_id), offense, expires=offense + NAUGHTY_LIST_TIME)
+
+    def save_naughty_list(self):
+        if NAUGHTY_LIST_PERSIST:
+            self.client.state.set(
+                'link_naughty',
+                {str(user_id): offense for user_id, offense in self.naughty_list.items()}
+            )
+
+    # ----------------------------------------------
+    # Link policy
+    # ----------------------------------------------
+    def load_policy(self):
+        rules = self.client.state.get('link_policy')
+        if rules is None:
+            rules = self.client.config.get('link_policy')
+        return LinkPolicy(rules)
+
+    def reload_policy(self):
+        """Re-read the link policy of config.json and reload the policy"""
+        with open('../config.json') as conffile:
+            self.client.config['link_policy'] = json.load(conffile).get('link_policy')
+        self.policy = self.load_policy()
+
+    def save_policy(self, policy):
+        self.policy = policy
+        self.client.state.set('link_policy', policy.rules)
+
     # ----------------------------------------------
     # Message checks
     # ----------------------------------------------
@@ -65,86 +139,105 @@ class LinkBlocker(commands.Cog, name='Link Blocker'):
 
     async def has_discord_link(self, msg):
         """Check message and return True if a discord link was detected"""
-        if len(re.findall(r'(?i)(discord(app)?\.(gg|io|me|co|com\/invite)\/\S+)', msg.content)):
+        if self.policy.has_invite(msg.content):
             if msg.author.id in self.allowed_once:
-                self.allowed_once.remove(msg.author.id)
+                self.allowed_once.discard(msg.author.id)
                 return False
-            else:
-                if str(msg.author.id) in self.naughty_list:
-                    last_time = self.naughty_list[str(msg.author.id)]
-                    if time.time() - last_time > self.NAUGHTY_LIST_TIME:
-                        self.naughty_list.pop(str(msg.author.id))
-                    else:
-                        return True
-                if not msg.author.bot:
-                    await msg.channel.send(
-                        f'Sorry {msg.author.mention}. ' +
-                        'Posting links to other servers is not allowed.'
-                    )
-                self.naughty_list[str(msg.author.id)] = time.time()
+            if msg.author.id in self.naughty_list:
+                # Informed already - delete silently
+                return True
+            if not msg.author.bot:
+                await msg.channel.send(
+                    f'Sorry {msg.author.mention}. ' +
+                    'Posting links to other servers is not allowed.'
+                )
+            self.naughty_list.set(msg.author.id, time.time())
+            self.save_naughty_list()
             return True
         return False
 
     async def has_forbidden_text(self, msg):
         """Check message and return True if forbidden text was detected"""
-        if len(re.findall(
-            r'(?i)(http(s)?\:\/\/(www\.)?(' +
-            '|'.join([s.replace('.', '\\.') for s in FORBIDDEN]) +
-            r'))\b',
-            msg.content
-        )):
-            return True
-        if len(re.findall(
-            r'(?i)(http(s)?\:\/\/(www\.)?[^\s]+(' +
-            '|'.join([s.replace('.', '\\.') for s in FORBIDDEN_FILETYPES]) +
-            r'))\b',
-            msg.content
-        )):
-            return True
-        return False
+        return self.policy.is_forbidden(msg.content)
 
     async def has_forbidden_attachments(self, msg):
         """Check message and return True if forbidden attachments were detected"""
         attachments = msg.attachments
         if not attachments:
             return False
-        forbidden = [
-            i for i in attachments if i.filename.endswith(FORBIDDEN_FILETYPES)
-        ]
-        if not forbidden:
-            return False
-        size = sum(i.size for i in forbidden)
-        # Do not attach files if the maximum upload size is exceeded
-        if size <= 8_000_000:
-            self.forbidden_files = [
-                File(
-                    BytesIO(await i.read()),
-                    filename=i.filename
-                ) for i in forbidden
-            ]
-        return True
+        filetypes = tuple(self.policy.rules['filetypes'])
+        for attachment in attachments:
+            known = await self.find_known_bad_file(attachment)
+            if known is not None:
+                msg.quarantined.append(known)
+            elif attachment.filename.lower().endswith(filetypes):
+                async with self.download_semaphore:
+                    quarantined = await quarantine(
+                        self.client.session, attachment, QUARANTINE_MAX_SIZE
+                    )
+                self.known_bad_files.add(quarantined)
+                msg.quarantined.append(quarantined)
+        return bool(msg.quarantined)
+
+    async def find_known_bad_file(self, attachment):
+        """Return a QuarantinedFile if attachment is a known bad file, otherwise None
+
+        Only the first bytes of the attachment are downloaded and only if its
+        size matches a known file."""
+        if not self.known_bad_files.might_be_known(attachment.size):
+            return None
+        async with self.download_semaphore:
+            prefix_sha256 = await fetch_prefix_hash(self.client.session, attachment.url)
+        sha256 = self.known_bad_files.lookup(attachment.size, prefix_sha256)
+        if sha256 is None:
+            return None
+        return QuarantinedFile(
+            attachment.filename, attachment.size, sha256, prefix_sha256, known=True
+        )
+
+    async def post_report(self, msg, quarantined=()):
+        """Post report of deletion to target channel
 
-    async def post_report(self, msg):
-        """Post report of deletion to target channel"""
+        quarantined is the list of QuarantinedFile of the message - they are
+        attached as long as the maximum upload size is not exceeded"""
         target = self.client.get_channel(self.REPORT_CHANNEL)
         extra_content = {}
         if msg.content:
             e = Embed(description=msg.content,
                       color=random.randint(0, 0xFFFFFF))
             extra_content['embed'] = e
-        if self.forbidden_files:
-            extra_content['files'] = self.forbidden_files
+        files = []
+        lines = []
+        upload_size = 0
+        for q in quarantined:
+            line = f'`{q.filename}` {q.size} bytes sha256: `{q.sha256 or "unknown"}`'
+            lines.append(line + (' (known bad file)' if q.known else ''))
+            if q.file is not None and upload_size + q.size <= QUARANTINE_MAX_SIZE:
+                files.append(q.to_discord_file())
+                upload_size += q.size
+        if files:
+            extra_content['files'] = files
         await target.send(
             f'<@&{self.REPORT_ROLE}> I deleted a message\n'
-            f'Message sent by {msg.author.mention} in {msg.channel.mention}',
+            f'Message sent by {msg.author.mention} in {msg.channel.mention}\n'
+            + '\n'.join(lines),
             **extra_content
         )
-        if self.forbidden_files:
-            self.forbidden_files.clear()
         return True
 
+    async def handle_forbidden(self, msg, checked):
+        """Delete a forbidden message and report it"""
+        try:
+            await msg.delete()
+            if not msg.author.bot:
+                await self.post_report(msg, checked.quarantined)
+        finally:
+            for q in checked.quarantined:
+                q.close()
+
     async def check_message(self, msg):
-        """Check message - return True if message contains forbidden text"""
+        """Check message - return the checked MinimalMessage if the message
+        is forbidden, otherwise None"""
         my_msg = MinimalMessage(
             msg.content,
             msg.author,
@@ -154,33 +247,38 @@ class LinkBlocker(commands.Cog, name='Link Blocker'):
         # ignore spoiler tags
         my_msg.content = my_msg.content.replace('||', '')
         if self.is_dm(my_msg):
-            return False
+            return None
         # if self.is_allowed(my_msg):
-            # return False
+            # return None
         if await self.has_discord_link(my_msg):
-            return True
+            return my_msg
         if await self.has_forbidden_text(my_msg):
-            return True
+            return my_msg
         if await self.has_forbidden_attachments(my_msg):
-            return True
-        return False
+            return my_msg
+        return None
+
+    # ----------------------------------------------
+    # Message pipeline stage
+    # ----------------------------------------------
+    async def process_message(self, ctx):
+        """Delete forbidden messages - later stages will not see them"""
+        msg = ctx.msg
+        checked = await self.check_message(msg)
+        if checked is None:
+            return False
+        await self.handle_forbidden(msg, checked)
+        return True
 
     # ----------------------------------------------
     # Event listeners
     # ----------------------------------------------
-    @commands.Cog.listener()
-    async def on_message(self, msg):
-        if await self.check_message(msg):
-            await msg.delete()
-            if not msg.author.bot:
-                await self.post_report(msg)
 
     @commands.Cog.listener()
     async def on_message_edit(self, before, after):
-        if await self.check_message(after):
-            await after.delete()
-            if not after.author.bot:
-                await self.post_report(after)
+        checked = await self.check_message(after)
+        if checked is not None:
+            await self.handle_forbidden(after, checked)
 
     # ----------------------------------------------
     # Command to allow 1 discord.gg link
@@ -192,7 +290,115 @@ class LinkBlocker(commands.Cog, name='Link Blocker'):
     async def allow(self, ctx, member: Member):
         """Allow a single discord.gg link by @user"""
         await ctx.send(f'Hey {member.mention}, you can post 1 discord.gg link!')
-        self.allowed_once.append(member.id)
+        self.allowed_once.add(member.id)
+
+    # ----------------------------------------------
+    # Cog Tasks
+    # ----------------------------------------------
+    @tasks.loop(seconds=NAUGHTY_LIST_SWEEP_INTERVAL)
+    async def sweep_naughty_list(self):
+        if self.naughty_list.expire():
+            self.save_naughty_list()
+
+    # ----------------------------------------------
+    # Link policy commands
+    # ----------------------------------------------
+    @commands.group(
+        invoke_without_command=True,
+        name='linkpolicy',
+        hidden=True,
+    )
+    async def linkpolicy(self, ctx):
+        """Show the link policy"""
+        lines = []
+        for key, values in self.policy.rules.items():
+            if len(values) > 20:
+                lines.append(f'{key}: {len(values)} entries')
+            else:
+                lines.append(f'{key}: {", ".join(values) or "-"}')
+        await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+    @linkpolicy.command(
+        name='add',
+    )
+    async def linkpolicy_add(self, ctx, kind: str, value: str):
+        """Add a rule [domain|allow|filetype]"""
+        if kind not in RULE_KINDS:
+            raise commands.BadArgument(f'Kind must be one of: {", ".join(RULE_KINDS)}')
+        self.save_policy(self.policy.with_rules(kind, [value]))
+        await ctx.send(f'`Added {kind} {value}`')
+
+    @linkpolicy.command(
+        name='remove',
+        aliases=['rm'],
+    )
+    async def linkpolicy_remove(self, ctx, kind: str, value: str):
+        """Remove a rule [domain|allow|filetype]"""
+        if kind not in RULE_KINDS:
+            raise commands.BadArgument(f'Kind must be one of: {", ".join(RULE_KINDS)}')
+        self.save_policy(self.policy.without_rules(kind, [value]))
+        await ctx.send(f'`Removed {kind} {value}`')
+
+    @linkpolicy.command(
+        name='import',
+    )
+    async def linkpolicy_import(self, ctx, url: str = None):
+        """Add the forbidden domains of a domain list or hosts file
+
+        Attach the file or pass the url of the file"""
+        if ctx.message.attachments:
+            text = (await ctx.message.attachments[0].read()).decode('utf-8', 'replace')
+        elif url:
+            try:
+                async with self.client.session.get(url) as response:
+                    if response.status != 200:
+                        raise commands.BadArgument(f'Download failed ({response.status})')
+                    text = await response.text(errors='replace')
+            except ClientError as e:
+                raise commands.BadArgument(f'Download failed ({type(e).__name__})')
+        else:
+            raise commands.BadArgument('Please attach a file or specify an url')
+        before = len(self.policy.rules['domains'])
+        self.save_policy(self.policy.with_rules('domain', parse_domain_list(text)))
+        added = len(self.policy.rules['domains']) - before
+        await ctx.send(f'`Imported {added} new domains`')
+
+    @linkpolicy.command(
+        name='reload',
+    )
+    async def linkpolicy_reload(self, ctx):
+        """Reload the link policy from the bot state and config.json"""
+        self.reload_policy()
+        await ctx.send('`Link policy reloaded`')
+
+    @linkpolicy.command(
+        name='reset',
+    )
+    async def linkpolicy_reset(self, ctx):
+        """Discard the changes made by command and use the policy of config.json"""
+        self.client.state.delete('link_policy')
+        self.reload_policy()
+        await ctx.send('`Link policy reset`')
+
+    @linkpolicy.command(
+        name='badfiles',
+    )
+    async def linkpolicy_badfiles(self, ctx):
+        """Show the number of known bad attachments"""
+        await ctx.send(f'`{len(self.known_bad_files)} known bad attachments`')
+
+    @linkpolicy.command(
+        name='forget',
+    )
+    async def linkpolicy_forget(self, ctx, sha256: str):
+        """Stop blocking a known bad attachment"""
+        if not self.known_bad_files.remove(sha256.lower()):
+            raise commands.BadArgument('Unknown hash')
+        await ctx.send('`Removed`')
+
+    def cog_unload(self):
+        self.client.message_pipeline.remove_stage('linkblocker')
+        self.sweep_naughty_list.cancel()
 
 
 def setup(client):
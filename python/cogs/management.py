@@ -12,6 +12,10 @@ Commands:
 
     pull            pull latest changes from github (superuser only)
     error           print the traceback of the last unhandled error to chat
+    http            show requests, errors and latency per host
+     ├clear             reset the http metrics
+     ├circuits          show the circuit breakers of the hosts
+     └reset             close the circuit breaker of a host
 
 Only users that have an admin role can use the commands.
 """
@@ -23,6 +27,7 @@ from datetime import datetime
 from os import path, listdir
 from discord import Activity, Embed, Member
 from discord.ext import commands
+from utils.circuit import CircuitOpenError, CLOSED
 
 
 class Management(commands.Cog, name='Management'):
@@ -106,6 +111,13 @@ class Management(commands.Cog, name='Management'):
             await ctx.send('`Unexpected quote encountered`')
             return
 
+        if isinstance(getattr(error, 'original', None), CircuitOpenError):
+            await ctx.send(
+                f'Sorry, `{error.original.host}` is not reachable at the moment. '
+                'Please try again later.'
+            )
+            return
+
         # In case of an unhandled error -> Save the error + current datetime + ctx + original text
         # so it can be accessed later with the error command
         await ctx.send('Sorry, something went wrong. The Error was saved - we will look into it.')
@@ -327,32 +339,25 @@ class Management(commands.Cog, name='Management'):
         """List duplicate usernames"""
         name_count = {}
         aka = {}
-        pages = []
         usernames = [(x.name, x.display_name) for x in ctx.guild.members]
         l_max = max([len(x[0]) for x in usernames]) + 1
         for name, display_name in usernames:
             name_count[name] = name_count.get(name, 0) + 1
             if not name == display_name:
                 aka[name] = aka.get(name, []) + [display_name]
-        page = []
+        lines = []
         for key, value in sorted(name_count.items(),
                                  key=lambda x: x[1], reverse=True):
             if value == 1:
                 break
-            if len('\n'.join(page)) > 1900:
-                pages.append(page)
-                page = []
             a = ', '.join(aka.get(key, []))
-            page.append(f'{value}x {key.ljust(l_max)}' + f'aka: {a}' * bool(a))
+            lines.append(f'{value}x {key.ljust(l_max)}' + f'aka: {a}' * bool(a))
 
-        if page:
-            pages.append(page)
-
-        if not pages:
+        if not lines:
             await ctx.send('No duplicate usernames found')
+            return
 
-        for n, page in enumerate(pages):
-            await ctx.send(f'{n+1}/{len(pages)}\n```' + '\n'.join(page) + '```')
+        await self.client.outbox.send_block(ctx.channel, lines)
 
     @_list.command(
         name='earliest'
@@ -409,6 +414,86 @@ class Management(commands.Cog, name='Management'):
             return
         await ctx.send('```css\n' + '\n'.join(result) + '\n```')
 
+    @commands.group(
+        invoke_without_command=True,
+        name='http',
+        hidden=True,
+    )
+    async def http(self, ctx):
+        """Show requests, errors and latency of the http client per host"""
+
+        hosts = self.client.http_metrics.hosts
+        if not hosts:
+            await ctx.send('No http requests recorded')
+            return
+
+        def latency(seconds):
+            if seconds is None:
+                return '-'
+            return f'<{seconds}s' if seconds != float('inf') else '>30s'
+
+        response = []
+        for host, metrics in sorted(hosts.items(), key=lambda item: -item[1].requests):
+            statuses = ' '.join(
+                f'{status}:{count}' for status, count in sorted(metrics.statuses.items())
+            )
+            errors = ' '.join(f'{name}:{count}' for name, count in metrics.errors.most_common())
+            response.append(
+                f'[{host}] requests: {metrics.requests} '
+                f'errors: {sum(metrics.errors.values())} '
+                f'p50: {latency(metrics.percentile(0.5))} '
+                f'p95: {latency(metrics.percentile(0.95))}'
+            )
+            response.append(f'  status: {statuses or "-"}')
+            if errors:
+                response.append(f'  errors: {errors}')
+        await self.client.outbox.send_block(ctx.channel, response, lang='css')
+
+    @http.command(name='clear')
+    async def http_clear(self, ctx):
+        """Reset the http metrics"""
+        self.client.http_metrics.clear()
+        await ctx.send('Http metrics cleared')
+
+    @http.command(
+        name='circuits',
+        aliases=['circuit'],
+    )
+    async def http_circuits(self, ctx):
+        """Show the circuit breakers that are not closed or had failures"""
+        circuits = [
+            circuit for circuit in self.client.session.circuits.values()
+            if circuit.state != CLOSED or circuit.failures
+        ]
+        if not circuits:
+            await ctx.send('All circuits are closed')
+            return
+        response = []
+        for circuit in sorted(circuits, key=lambda circuit: circuit.host):
+            line = (
+                f'[{circuit.host}] {circuit.state} - failures: {circuit.failures} '
+                f'rejected: {circuit.rejected}'
+            )
+            if circuit.state != CLOSED:
+                line += f' next try in: {circuit.retry_in():.0f}s'
+            response.append(line)
+        await self.client.outbox.send_block(ctx.channel, response, lang='css')
+
+    @http.command(name='reset')
+    async def http_reset(self, ctx, host: str = None):
+        """Close the circuit breaker of [host] or of all hosts"""
+        circuits = self.client.session.circuits
+        if host is None:
+            for circuit in circuits.values():
+                circuit.reset()
+            await ctx.send('Closed all circuits')
+            return
+        if host not in circuits:
+            await ctx.send(f'No circuit for `{host}`')
+            return
+        circuits[host].reset()
+        await ctx.send(f'Closed the circuit of `{host}`')
+
     @commands.group(
         invoke_without_command=True,
         name='error',
@@ -422,15 +507,13 @@ class Management(commands.Cog, name='Management'):
             await self.print_traceback(ctx, n)
             return
 
-        NUM_ERRORS_PER_PAGE = 15
-
         error_log = self.client.last_errors
 
         if not error_log:
             await ctx.send('Error log is empty')
             return
 
-        response = [f'```css\nNumber of stored errors: {len(error_log)}']
+        response = [f'Number of stored errors: {len(error_log)}']
         for i, exc_tuple in enumerate(error_log):
             exc, date, error_source, *_ = exc_tuple
             call_info = (
@@ -444,13 +527,7 @@ class Management(commands.Cog, name='Management'):
                 + call_info
                 + f']\nException: {exc}'
             )
-            if i % NUM_ERRORS_PER_PAGE == NUM_ERRORS_PER_PAGE-1:
-                response.append('```')
-                await ctx.send('\n'.join(response))
-                response = [f'```css']
-        if len(response) > 1:
-            response.append('```')
-            await ctx.send('\n'.join(response))
+        await self.client.outbox.send_block(ctx.channel, response, lang='css')
 
     @error.command(
         name='clear',
@@ -511,24 +588,16 @@ class Management(commands.Cog, name='Management'):
             else:
                 response.append(f'`Command: No Command`')
                 response.append(error_source.jump_url)
-        response.append(f'```python\n')
-        num_chars = sum(len(line) for line in response)
-        for line in tb.split('\n'):
-            num_chars += len(line)
-            response.append(line)
-            if num_chars > 1900:
-                response.append('```')
-                await ctx.send('\n'.join(response))
-                response = ['```python\n']
-                num_chars = 0
-        response.append('```')
-        await ctx.send('\n'.join(response))
+        outbox = self.client.outbox
+        outbox.send(ctx.channel, '\n'.join(response))
+        last_message = outbox.send_block(ctx.channel, tb.split('\n'), lang='python')
         if error_source is not None:
             e = Embed(title='Full command that caused the error:',
                       description=orig_content)
             e.set_footer(text=error_source.author.display_name,
                          icon_url=error_source.author.avatar_url)
-        await ctx.send(embed=e)
+            last_message = outbox.send(ctx.channel, embed=e)
+        await last_message
 
 
 def setup(client):
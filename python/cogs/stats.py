@@ -9,7 +9,6 @@ Commands:
 Only users that have an admin role can use the commands.
 """
 
-import json
 import time
 import typing
 from datetime import datetime, timedelta
@@ -25,22 +24,14 @@ class Stats(commands.Cog, name='Stats'):
     async def cog_check(self, ctx):
         return self.client.user_is_admin(ctx.author)
 
-    def load_state(self):
-        with open("../state.json", "r") as statefile:
-            return json.load(statefile)
-
     def load_stats(self):
-        state = self.load_state()
-        stats = state.get('stats', dict())
+        stats = self.client.state.get('stats', dict())
         if not isinstance(stats, dict):
             stats = dict()
         return stats
 
     def save_stats(self, stats):
-        state = self.load_state()
-        state['stats'] = stats
-        with open("../state.json", "w") as statefile:
-            return json.dump(state, statefile, indent=1)
+        self.client.state.set('stats', stats)
 
     @commands.group(
         invoke_without_command=True,
@@ -0,0 +1,18 @@
+"""Tests for utils/linkpolicy.py - run from the python folder: python -m pytest tests"""
+from utils.linkpolicy import LinkPolicy, extract_urls
+
+
+def test_backslash_ends_the_host():
+    assert extract_urls(r'https://patreon.com\x') == [('patreon.com', '/x')]
+
+
+def test_backslash_url_is_forbidden():
+    policy = LinkPolicy()
+    assert policy.is_forbidden(r'support me https://patreon.com\x')
+    assert policy.is_forbidden(r'https://www.patreon.com\\user')
+    assert not policy.is_forbidden(r'https://example.com\patreon.com')
+
+
+def test_forbidden_filetype_behind_backslash():
+    policy = LinkPolicy({'filetypes': ['.exe']})
+    assert policy.is_forbidden(r'https://example.com\files\setup.exe')
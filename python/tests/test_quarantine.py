@@ -0,0 +1,27 @@
+"""Tests for utils/quarantine.py - run from the python folder: python -m pytest tests"""
+from tempfile import SpooledTemporaryFile
+from utils.quarantine import QuarantinedFile, SPOOL_MEMORY
+
+
+def quarantined_spool(size):
+    spool = SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    spool.write(b'x' * size)
+    return QuarantinedFile('malware.exe', size, file=spool)
+
+
+def test_discord_file_from_memory_spool():
+    quarantined = quarantined_spool(100)
+    file = quarantined.to_discord_file()
+    assert file.filename == 'malware.exe'
+    assert file.fp.read() == b'x' * 100
+    file.close()
+    quarantined.close()
+
+
+def test_discord_file_from_rolled_over_spool():
+    quarantined = quarantined_spool(SPOOL_MEMORY + 1)
+    file = quarantined.to_discord_file()
+    assert len(file.fp.read()) == SPOOL_MEMORY + 1
+    file.close()
+    quarantined.close()
+    assert quarantined.file.closed
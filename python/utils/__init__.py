@@ -0,0 +1,5 @@
+"""Shared helpers for Felix and its extensions/cogs
+
+Modules in this package are not extensions, they are imported by bot.py
+and by the cogs that need them.
+"""
@@ -0,0 +1,56 @@
+"""Cache helpers for Felix"""
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A dict like cache that holds at most maxsize entries
+
+    If the cache is full, the least recently used entry is dropped. If
+    maxweight is given, the total weight(value) of the entries is capped
+    as well.
+    """
+
+    def __init__(self, maxsize=128, maxweight=None, weight=None):
+        self.maxsize = maxsize
+        self.maxweight = maxweight
+        self.weight = weight or (lambda value: 0)
+        self.total_weight = 0
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def set(self, key, value):
+        """Store value - return a list of (key, value) tuples that were dropped"""
+        self.pop(key)
+        self.data[key] = value
+        self.total_weight += self.weight(value)
+        dropped = []
+        while len(self.data) > self.maxsize or self.too_heavy():
+            dropped_key, dropped_value = self.data.popitem(last=False)
+            self.total_weight -= self.weight(dropped_value)
+            dropped.append((dropped_key, dropped_value))
+        return dropped
+
+    def too_heavy(self):
+        return self.maxweight is not None and self.total_weight > self.maxweight
+
+    def pop(self, key, default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.total_weight -= self.weight(value)
+        return value
+
+    def clear(self):
+        self.data.clear()
+        self.total_weight = 0
@@ -0,0 +1,91 @@
+"""Circuit breakers for the hosts that Felix sends requests to
+
+A breaker starts closed. After threshold consecutive failures (connection
+errors, timeouts and 5xx responses) it opens and every request to the host
+fails immediately with CircuitOpenError instead of waiting for a timeout.
+After reset_timeout seconds it is half-open: one probe request is let
+through. If the probe succeeds the breaker closes, if it fails the breaker
+opens again with twice the reset timeout (up to max_reset_timeout).
+
+CircuitOpenError is a ClientError, code that handles failed requests
+handles it as well.
+"""
+import time
+from aiohttp import ClientError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(ClientError):
+    def __init__(self, host, retry_in):
+        self.host = host
+        self.retry_in = retry_in
+        super().__init__(f'{host} is unavailable - next try in {retry_in:.0f}s')
+
+
+class CircuitBreaker:
+    def __init__(self, host, threshold=5, reset_timeout=30, max_reset_timeout=600,
+                 clock=time.monotonic):
+        self.host = host
+        self.threshold = threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        # Number of requests that were rejected while the breaker was open
+        self.rejected = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if self.clock() - self.opened_at < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    def retry_in(self):
+        if self.opened_at is None:
+            return 0
+        return max(0, self.opened_at + self.reset_timeout - self.clock())
+
+    def before_request(self):
+        """Raise CircuitOpenError if the request must not be sent"""
+        state = self.state
+        if state == CLOSED:
+            return
+        if state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(self.host, self.retry_in())
+
+    def record(self, success):
+        if success:
+            self.reset()
+            return
+        self.failures += 1
+        if self.probing:
+            # The probe failed - wait longer before the next one
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self.open()
+        elif self.opened_at is None and self.failures >= self.threshold:
+            self.open()
+
+    def abort(self):
+        """The request was cancelled - its outcome is unknown"""
+        self.probing = False
+
+    def open(self):
+        self.opened_at = self.clock()
+        self.probing = False
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.reset_timeout = self.base_reset_timeout
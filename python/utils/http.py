@@ -0,0 +1,488 @@
+"""HTTP helpers for Felix
+
+CachedSession wraps the aiohttp ClientSession of the bot (client.session).
+It is used exactly like a ClientSession:
+
+    async with self.client.session.get(url) as response:
+        data = await response.json()
+
+GET requests to urls that match a cache rule are answered from a cache:
+    - every rule has a ttl and a stale time. Responses younger than ttl are
+      served from the cache. Older responses (up to ttl + stale) are served
+      immediately while a fresh copy is fetched in the background.
+    - identical requests that run at the same time share one request (see
+      utils/singleflight.py). Rules with a ttl of 0 only do that - their
+      responses are not stored.
+    - the cache holds at most maxsize responses and max_bytes bytes of
+      response bodies in memory - the least recently used ones are moved to
+      spill_dir on disk
+    - if a request fails, an outdated cached response is served if there is one
+Only responses with status 200 are stored. Cached requests return a
+CachedResponse (status, headers, read(), text(), json()) instead of an
+aiohttp ClientResponse. All other requests are passed to the ClientSession.
+
+Every request (cached or not) also gets:
+    - the connect and read timeout of the first matching timeout rule
+    - a slot of its host if the host has a limit in host_limits. A slow host
+      can only use that many connections, the others stay free for the
+      rest of the bot.
+    - the circuit breaker of its host (see utils/circuit.py). Requests to a
+      host that keeps failing raise CircuitOpenError right away - cached
+      requests serve an outdated response then if there is one.
+
+create_client_session() builds the ClientSession from the "http" section of
+the config. HttpMetrics records latency, status codes and errors per host.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from glob import glob
+from aiohttp import (ClientError, ClientResponseError, ClientSession, ClientTimeout,
+                     RequestInfo, TCPConnector, TraceConfig)
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+from utils.cache import LRUCache
+from utils.circuit import CircuitBreaker
+from utils.singleflight import SingleFlight
+
+# (url prefix, ttl, stale) - the first matching rule is used
+DEFAULT_CACHE_RULES = [
+    ('https://api.chucknorris.io/jokes/random', 0, 0),
+    ('https://api.nasa.gov/planetary/apod', 3600, 86400),
+    ('https://wttr.in/', 900, 1800),
+    ('http://api.urbandictionary.com/', 3600, 86400),
+    ('http://api.giphy.com/v1/gifs/search', 3600, 86400),
+    ('https://api.wolframalpha.com/v1/result', 600, 0),
+    ('https://www.googleapis.com/youtube/v3/search', 3600, 86400),
+    ('https://www.googleapis.com/youtube/v3/channels', 600, 3600),
+    ('https://cheat.sh/', 86400, 604800),
+    ('https://api.chucknorris.io/jokes/categories', 86400, 604800),
+    ('https://emkc.org/api/v1/stats/', 300, 600),
+    ('https://mydogchase.com', 3600, 86400),
+    ('https://api.github.com/repos/', 300, 0),
+]
+
+# (url prefix, connect timeout, read timeout) - the first matching rule is used
+DEFAULT_TIMEOUTS = [
+    ('https://emkc.org/', 3, 10),
+    ('https://cheat.sh/', 3, 10),
+    ('https://wttr.in/', 3, 10),
+    ('https://api.wolframalpha.com/', 3, 15),
+]
+
+# Key: host | Value: max number of concurrent requests
+DEFAULT_HOST_LIMITS = {
+    'emkc.org': 8,
+}
+
+# Settings of the "http" section of the config
+DEFAULT_HTTP_CONFIG = {
+    'limit': 100,  # connections of the whole pool
+    'limit_per_host': 10,
+    'ttl_dns_cache': 300,  # Seconds
+    'keepalive_timeout': 30,  # Seconds
+    'connect_timeout': 5,  # Seconds
+    'read_timeout': 20,  # Seconds
+    'total_timeout': 60,  # Seconds
+}
+
+# Upper bounds of the latency buckets in seconds - the last bucket is unbounded
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+@dataclass
+class HostMetrics:
+    requests: int = 0
+    latency: list = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+    statuses: Counter = field(default_factory=Counter)
+    # Key: name of the exception | Value: count
+    errors: Counter = field(default_factory=Counter)
+
+    def record(self, seconds, status):
+        self.requests += 1
+        self.statuses[status] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency[i] += 1
+                return
+        self.latency[-1] += 1
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket that holds the q-quantile
+        (float('inf') for the last bucket) or None if there is no data"""
+        total = sum(self.latency)
+        if not total:
+            return None
+        seen = 0
+        for i, count in enumerate(self.latency):
+            seen += count
+            if seen >= q * total:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+
+
+class HttpMetrics:
+    """Records the requests of a ClientSession through a TraceConfig
+
+    The latency is the time until the response headers arrived.
+    """
+
+    def __init__(self):
+        # Key: host | Value: HostMetrics
+        self.hosts = {}
+
+    def host(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostMetrics()
+        return self.hosts[host]
+
+    def clear(self):
+        self.hosts = {}
+
+    def trace_config(self):
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_request_exception.append(self.on_request_exception)
+        return trace_config
+
+    async def on_request_start(self, session, ctx, params):
+        ctx.start = time.monotonic()
+
+    async def on_request_end(self, session, ctx, params):
+        self.host(params.url.host).record(time.monotonic() - ctx.start, params.response.status)
+
+    async def on_request_exception(self, session, ctx, params):
+        self.host(params.url.host).errors[type(params.exception).__name__] += 1
+
+
+def create_client_session(http_config, metrics=None):
+    """Create the ClientSession of the bot from the "http" section of the config"""
+    settings = {**DEFAULT_HTTP_CONFIG, **http_config}
+    connector = TCPConnector(
+        limit=settings['limit'],
+        limit_per_host=settings['limit_per_host'],
+        ttl_dns_cache=settings['ttl_dns_cache'],
+        keepalive_timeout=settings['keepalive_timeout'],
+    )
+    timeout = ClientTimeout(
+        total=settings['total_timeout'],
+        sock_connect=settings['connect_timeout'],
+        sock_read=settings['read_timeout'],
+    )
+    trace_configs = [metrics.trace_config()] if metrics is not None else None
+    return ClientSession(connector=connector, timeout=timeout, trace_configs=trace_configs)
+
+
+@dataclass
+class CachedResponse:
+    # Without the query - it may hold api keys and entries are written to disk
+    url: str
+    status: int
+    headers: dict
+    body: bytes
+    charset: str
+    fetched: float
+
+    async def read(self):
+        return self.body
+
+    async def text(self, encoding=None, errors='strict'):
+        return self.body.decode(encoding or self.charset or 'utf-8', errors)
+
+    async def json(self, *, encoding=None, loads=json.loads, content_type=None):
+        return loads(await self.text(encoding))
+
+    def release(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status < 400:
+            return
+        url = URL(self.url)
+        request_info = RequestInfo(url, 'GET', CIMultiDictProxy(CIMultiDict()), url)
+        raise ClientResponseError(
+            request_info, (), status=self.status, message='cached error', headers=self.headers
+        )
+
+
+class CachedRequest:
+    """Makes a cached request usable with "async with" and "await" """
+
+    def __init__(self, coro):
+        self.coro = coro
+
+    def __await__(self):
+        return self.coro.__await__()
+
+    async def __aenter__(self):
+        return await self.coro
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class HostRequest:
+    """A request that holds a slot of its host while it is open and reports
+    its outcome to the circuit breaker of the host
+
+    The request is only created after the breaker let it through and a slot
+    was acquired.
+    """
+
+    def __init__(self, make_request, circuit, semaphore=None):
+        self.make_request = make_request
+        self.circuit = circuit
+        self.semaphore = semaphore
+        self.request = None
+        self.response = None
+
+    def __await__(self):
+        return self.send().__await__()
+
+    async def send(self):
+        # Without "async with" the slot is only held until the headers arrived
+        response = await self.__aenter__()
+        self.release()
+        return response
+
+    async def __aenter__(self):
+        self.circuit.before_request()
+        try:
+            if self.semaphore is not None:
+                await self.semaphore.acquire()
+        except BaseException:
+            self.circuit.abort()
+            raise
+        try:
+            self.request = self.make_request()
+            self.response = await self.request.__aenter__()
+        except (ClientError, asyncio.TimeoutError):
+            self.circuit.record(False)
+            self.release()
+            raise
+        except BaseException:
+            self.circuit.abort()
+            self.release()
+            raise
+        self.circuit.record(self.response.status < 500)
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.request.__aexit__(exc_type, exc, tb)
+        finally:
+            self.release()
+        # Errors while the body was read count as well
+        if exc_type is not None and issubclass(exc_type, (ClientError, asyncio.TimeoutError)):
+            self.circuit.record(False)
+
+    def release(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
+            self.semaphore = None
+
+
+class CachedSession:
+    def __init__(self, session, rules=DEFAULT_CACHE_RULES, maxsize=256, singleflight=None,
+                 spill_dir=None, max_spilled=2048, max_body=2_000_000, max_bytes=32_000_000,
+                 timeouts=DEFAULT_TIMEOUTS, host_limits=DEFAULT_HOST_LIMITS,
+                 circuit_threshold=5, circuit_reset_timeout=30):
+        self.session = session
+        self.rules = rules
+        self.timeouts = timeouts
+        self.host_limits = host_limits
+        # Key: host | Value: semaphore - created on the first request to the host
+        self.host_semaphores = {}
+        self.circuit_threshold = circuit_threshold
+        self.circuit_reset_timeout = circuit_reset_timeout
+        # Key: host | Value: CircuitBreaker
+        self.circuits = {}
+        self.cache = LRUCache(maxsize, maxweight=max_bytes, weight=lambda entry: len(entry.body))
+        self.max_body = max_body
+        self.singleflight = singleflight or SingleFlight()
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+        # Key: cache key | Value: file name
+        self.spilled = OrderedDict()
+        if spill_dir is not None:
+            # Spilled responses of the last run are not used again
+            os.makedirs(spill_dir, exist_ok=True)
+            for filename in glob(os.path.join(spill_dir, '*.pickle')):
+                os.remove(filename)
+
+    def __getattr__(self, name):
+        # close(), closed, cookie_jar, ... of the ClientSession
+        return getattr(self.session, name)
+
+    def rule(self, url):
+        """Return (ttl, stale) of the first rule that matches url or None"""
+        for prefix, ttl, stale in self.rules:
+            if url.startswith(prefix):
+                return ttl, stale
+        return None
+
+    @staticmethod
+    def cache_key(url, kwargs):
+        key = SingleFlight.url_key(url, kwargs.get('params'), kwargs.get('headers'))
+        # Keys may contain api keys - only keep a hash
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def request(self, method, url, **kwargs):
+        if method.upper() == 'GET':
+            return self.get(url, **kwargs)
+        return self.send(method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        rule = self.rule(str(url))
+        if rule is None or 'data' in kwargs or 'json' in kwargs:
+            return self.send('GET', url, kwargs)
+        return CachedRequest(self.cached_get(url, rule, kwargs))
+
+    def post(self, url, **kwargs):
+        return self.send('POST', url, kwargs)
+
+    # ----------------------------------------------
+    # Timeouts, host limits and circuit breakers
+    # ----------------------------------------------
+    def timeout(self, url):
+        """Return the ClientTimeout of the first timeout rule that matches url or None"""
+        for prefix, connect, read in self.timeouts:
+            if url.startswith(prefix):
+                # The total timeout of the session still applies
+                return ClientTimeout(
+                    total=self.session.timeout.total,
+                    sock_connect=connect,
+                    sock_read=read
+                )
+        return None
+
+    def host_semaphore(self, host):
+        limit = self.host_limits.get(host)
+        if limit is None:
+            return None
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(limit)
+        return self.host_semaphores[host]
+
+    def circuit(self, host):
+        if host not in self.circuits:
+            self.circuits[host] = CircuitBreaker(
+                host,
+                threshold=self.circuit_threshold,
+                reset_timeout=self.circuit_reset_timeout
+            )
+        return self.circuits[host]
+
+    def send(self, method, url, kwargs):
+        """Pass a request to the ClientSession"""
+        if 'timeout' not in kwargs:
+            timeout = self.timeout(str(url))
+            if timeout is not None:
+                kwargs = {**kwargs, 'timeout': timeout}
+        host = URL(str(url)).host
+        return HostRequest(
+            lambda: self.session.request(method, url, **kwargs),
+            self.circuit(host),
+            self.host_semaphore(host)
+        )
+
+    # ----------------------------------------------
+    # Cache
+    # ----------------------------------------------
+    async def cached_get(self, url, rule, kwargs):
+        ttl, stale = rule
+        key = self.cache_key(url, kwargs)
+        entry = self.cache.get(key) if ttl else None
+        if entry is None and ttl:
+            entry = await self.load_spilled(key)
+        if entry is not None:
+            age = time.time() - entry.fetched
+            if age < ttl:
+                return entry
+            if age < ttl + stale:
+                self.revalidate(key, url, kwargs)
+                return entry
+        try:
+            return await self.singleflight.do(key, self.fetch, key, url, kwargs, ttl > 0)
+        except (ClientError, asyncio.TimeoutError):
+            if entry is not None:
+                return entry
+            raise
+
+    def revalidate(self, key, url, kwargs):
+        """Fetch a fresh copy in the background"""
+        if key in self.singleflight:
+            return
+        task = self.singleflight.start(key, self.fetch, key, url, kwargs, True)
+        # Errors are ignored - the cached copy is served until it is too old
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def fetch(self, key, url, kwargs, cache):
+        async with self.send('GET', url, kwargs) as response:
+            body = await response.read()
+            entry = CachedResponse(
+                str(response.url.with_query(None)),
+                response.status,
+                dict(response.headers),
+                body,
+                response.charset,
+                time.time()
+            )
+        if cache and entry.status == 200 and len(body) <= self.max_body:
+            self.store(key, entry)
+        return entry
+
+    def store(self, key, entry):
+        dropped = self.cache.set(key, entry)
+        if self.spill_dir is None:
+            return
+        loop = asyncio.get_event_loop()
+        for dropped_key, dropped_entry in dropped:
+            filename = os.path.join(self.spill_dir, f'{dropped_key}.pickle')
+            self.spilled[dropped_key] = filename
+            self.spilled.move_to_end(dropped_key)
+            loop.run_in_executor(None, self.write_spilled, filename, dropped_entry)
+        while len(self.spilled) > self.max_spilled:
+            _, filename = self.spilled.popitem(last=False)
+            loop.run_in_executor(None, self.remove_spilled, filename)
+
+    async def load_spilled(self, key):
+        filename = self.spilled.pop(key, None)
+        if filename is None:
+            return None
+        loop = asyncio.get_event_loop()
+        entry = await loop.run_in_executor(None, self.read_spilled, filename)
+        if entry is not None:
+            self.store(key, entry)
+        return entry
+
+    # ----------------------------------------------
+    # Disk spill - these run in an executor
+    # ----------------------------------------------
+    @staticmethod
+    def write_spilled(filename, entry):
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(entry, f)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def read_spilled(filename):
+        try:
+            with open(filename, 'rb') as f:
+                entry = pickle.load(f)
+            os.remove(filename)
+            return entry
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    @staticmethod
+    def remove_spilled(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
@@ -0,0 +1,162 @@
+"""Link policy for the link blocker
+
+A LinkPolicy holds the link rules. The URLs of a message are extracted once,
+their hosts are normalized (lowercase, punycode, without "www.") and looked
+up in a DomainTrie, so a lookup costs one step per label of the host no
+matter how many domains are listed. A rule for a domain also covers all of
+its subdomains, the longest matching rule wins - so an allowed subdomain of
+a blocked domain is allowed.
+
+Policies are immutable - to change the rules create a new policy with
+with_rules() / without_rules().
+
+Rules are a dict like
+    {
+        "domains": ["patreon.com", "gofundme.com"],
+        "allowed": ["help.patreon.com"],
+        "filetypes": [".exe"]
+    }
+"""
+import re
+
+# Kinds of rules and the key they are stored under
+RULE_KINDS = {
+    'domain': 'domains',
+    'allow': 'allowed',
+    'filetype': 'filetypes',
+}
+
+DEFAULT_RULES = {
+    'domains': [
+        'patreon.com',
+        'gofundme.com',
+        'gofund.me',
+    ],
+    'allowed': [],
+    'filetypes': [
+        '.exe',
+    ],
+}
+
+INVITE_REGEX = re.compile(r'discord(app)?\.(gg|io|me|co|com\/invite)\/\S+', re.IGNORECASE)
+# Groups: host, path
+# Browsers treat "\\" like "/" - it ends the host as well
+URL_REGEX = re.compile(r'\b(?:https?|hxxps?)://([^\s/\\?#<>|]+)([^\s<>|]*)', re.IGNORECASE)
+# "example[.]com", "example(.)com", "example[dot]com"
+OBFUSCATED_DOT_REGEX = re.compile(r'\s?[\[\(\{]\s*(?:\.|dot)\s*[\]\)\}]\s?', re.IGNORECASE)
+
+
+# Characters that end an url in a message (markdown, brackets, punctuation)
+TRAILING_CHARS = ')]}>\'"!,;.*_~`'
+
+
+def normalize_host(host):
+    """Return the host of an url in the form the rules use"""
+    host = host.rpartition('@')[2].rstrip(TRAILING_CHARS)
+    host = host.split(':', 1)[0].strip('.').lower()
+    try:
+        host = host.encode('idna').decode('ascii')
+    except UnicodeError:
+        pass
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+def normalize_rule(kind, value):
+    value = value.strip().lower()
+    if kind == 'filetype':
+        if not value.startswith('.'):
+            value = '.' + value
+        return value
+    return normalize_host(value)
+
+
+def extract_urls(text):
+    """Return a list of (normalized host, lowercase path) of all urls in text"""
+    urls = []
+    for host, path in URL_REGEX.findall(OBFUSCATED_DOT_REGEX.sub('.', text)):
+        path = path.replace('\\', '/').lower().split('?', 1)[0].split('#', 1)[0]
+        path = path.rstrip(TRAILING_CHARS)
+        urls.append((normalize_host(host), path))
+    return urls
+
+
+class DomainTrie:
+    """Maps domains to values - a domain also matches all of its subdomains
+
+    The labels are stored reversed ("com" -> "example" -> "www").
+    """
+
+    END = ''
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, domain, value):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[self.END] = value
+
+    def match(self, host):
+        """Return the value of the longest domain that host belongs to or None"""
+        node = self.root
+        result = None
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            result = node.get(self.END, result)
+        return result
+
+
+class LinkPolicy:
+    def __init__(self, rules=None):
+        rules = DEFAULT_RULES if rules is None else rules
+        self.rules = {
+            key: sorted({normalize_rule(kind, v) for v in rules.get(key, [])} - {''})
+            for kind, key in RULE_KINDS.items()
+        }
+        self.domains = DomainTrie()
+        for domain in self.rules['domains']:
+            self.domains.add(domain, True)
+        for domain in self.rules['allowed']:
+            self.domains.add(domain, False)
+        self.filetypes = tuple(self.rules['filetypes'])
+
+    def has_invite(self, text):
+        return INVITE_REGEX.search(text) is not None
+
+    def is_forbidden_url(self, host, path):
+        if self.domains.match(host):
+            return True
+        return bool(self.filetypes) and path.endswith(self.filetypes)
+
+    def is_forbidden(self, text):
+        return any(self.is_forbidden_url(host, path) for host, path in extract_urls(text))
+
+    def with_rules(self, kind, values):
+        rules = {key: list(v) for key, v in self.rules.items()}
+        rules[RULE_KINDS[kind]] += values
+        return LinkPolicy(rules)
+
+    def without_rules(self, kind, values):
+        values = {normalize_rule(kind, value) for value in values}
+        rules = {key: list(v) for key, v in self.rules.items()}
+        rules[RULE_KINDS[kind]] = [v for v in rules[RULE_KINDS[kind]] if v not in values]
+        return LinkPolicy(rules)
+
+
+def parse_domain_list(text):
+    """Return the domains of a domain list or hosts file
+
+    Empty lines and comments (#) are ignored, for lines with more than
+    one word (hosts files: "0.0.0.0 example.com") the last word is used.
+    """
+    domains = []
+    for line in text.splitlines():
+        words = line.split('#', 1)[0].split()
+        if words:
+            domains.append(words[-1])
+    return domains
@@ -0,0 +1,197 @@
+"""Rotating, compressed and indexed storage for the chat log
+
+The chat log consists of segments. The active segment is a plain text file
+(e.g. discord_chat.log) that new lines are appended to. It is rotated when
+the day changes or when it grows larger than max_size.
+
+A closed segment is stored as
+    discord_chat.<first timestamp>.log.gz      gzip file
+    discord_chat.<first timestamp>.idx         index
+The gzip file is made of independent gzip members of ~block_size bytes each,
+so it can still be read with zcat / zgrep. The index holds one line per
+member: "<timestamp of the first line>\\t<byte offset of the member>".
+To read a time window only the members that overlap it are decompressed.
+
+Every line of the log has to start with an iso formatted timestamp followed
+by a "|". All methods of ChatLogStore block, call them from an executor.
+"""
+import gzip
+import os
+import threading
+from bisect import bisect_right
+from glob import glob
+
+
+def line_timestamp(line):
+    """Return the timestamp at the start of a log line (bytes or str)"""
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+    return line.split('|', 1)[0]
+
+
+class ChatLogStore:
+    def __init__(self, filename, max_size=256_000_000, block_size=65536):
+        self.filename = filename
+        self.prefix, self.extension = os.path.splitext(filename)
+        self.max_size = max_size
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.logfile = open(filename, 'a', encoding='utf-8')
+        self.segment_day = self.first_timestamp(filename)[:10] or None
+        # Compress segments that were closed but not compressed yet
+        # (e.g. the bot was stopped during compression)
+        for segment in self.plain_segments():
+            self.compress_in_background(segment)
+
+    # ----------------------------------------------
+    # Segment files
+    # ----------------------------------------------
+    def segment_name(self, start, suffix):
+        return f'{self.prefix}.{start}{suffix}'
+
+    def compressed_segments(self):
+        return sorted(glob(self.segment_name('*', self.extension + '.gz')))
+
+    def plain_segments(self):
+        return sorted(glob(self.segment_name('*', self.extension)))
+
+    def segment_start(self, segment):
+        """Return the timestamp encoded in a segment file name"""
+        start = segment[len(self.prefix) + 1:].split(self.extension, 1)[0]
+        day, _, clock = start.partition('T')
+        return f'{day}T{clock.replace("-", ":")}'
+
+    @staticmethod
+    def first_timestamp(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return line_timestamp(f.readline())
+        except FileNotFoundError:
+            return ''
+
+    # ----------------------------------------------
+    # Writing
+    # ----------------------------------------------
+    def write(self, lines):
+        """Append lines to the active segment and rotate it if needed"""
+        if not lines:
+            return
+        with self.lock:
+            for line in lines:
+                day = line[:10]
+                if self.segment_day is None:
+                    self.segment_day = day
+                elif day != self.segment_day or self.logfile.tell() >= self.max_size:
+                    self.rotate()
+                    self.segment_day = day
+                self.logfile.write(line)
+            self.logfile.flush()
+
+    def rotate(self):
+        """Close the active segment and compress it in a background thread"""
+        self.logfile.close()
+        start = self.first_timestamp(self.filename)[:19].replace(':', '-')
+        target = self.segment_name(start, self.extension)
+        n = 1
+        while os.path.exists(target) or os.path.exists(target + '.gz'):
+            target = self.segment_name(f'{start}.{n}', self.extension)
+            n += 1
+        os.replace(self.filename, target)
+        self.logfile = open(self.filename, 'a', encoding='utf-8')
+        self.compress_in_background(target)
+
+    def compress_in_background(self, segment):
+        threading.Thread(target=self.compress, args=(segment,), daemon=True).start()
+
+    def compress(self, segment):
+        """Compress a closed plain segment block by block and write its index"""
+        target = segment + '.gz'
+        index_file = os.path.splitext(segment)[0] + '.idx'
+        index = []
+        with open(segment, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+            block = []
+            block_len = 0
+            for line in src:
+                block.append(line)
+                block_len += len(line)
+                if block_len >= self.block_size:
+                    index.append((line_timestamp(block[0]), dst.tell()))
+                    dst.write(gzip.compress(b''.join(block)))
+                    block = []
+                    block_len = 0
+            if block:
+                index.append((line_timestamp(block[0]), dst.tell()))
+                dst.write(gzip.compress(b''.join(block)))
+        with open(index_file + '.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(f'{timestamp}\t{offset}\n' for timestamp, offset in index)
+        os.replace(index_file + '.tmp', index_file)
+        os.replace(target + '.tmp', target)
+        os.remove(segment)
+
+    def close(self):
+        with self.lock:
+            self.logfile.close()
+
+    # ----------------------------------------------
+    # Reading
+    # ----------------------------------------------
+    def read_index(self, segment):
+        index = []
+        with open(segment.rsplit(self.extension, 1)[0] + '.idx', encoding='utf-8') as f:
+            for line in f:
+                timestamp, offset = line.rstrip('\n').split('\t')
+                index.append((timestamp, int(offset)))
+        return index
+
+    def read_compressed(self, segment, start, end):
+        index = self.read_index(segment)
+        if not index:
+            return
+        # Start at the last block that begins before the window
+        pos = max(bisect_right([timestamp for timestamp, _ in index], start) - 1, 0)
+        with open(segment, 'rb') as f:
+            f.seek(index[pos][1])
+            with gzip.GzipFile(fileobj=f) as gz:
+                yield from self.filter_lines(gz, start, end)
+
+    def read_plain(self, filename, start, end):
+        with open(filename, 'rb') as f:
+            yield from self.filter_lines(f, start, end)
+
+    @staticmethod
+    def filter_lines(lines, start, end):
+        for line in lines:
+            timestamp = line_timestamp(line)
+            if timestamp >= end:
+                return
+            if timestamp >= start:
+                yield line.decode('utf-8', 'replace')
+
+    def read_window(self, start, end):
+        """Yield all log lines with start <= timestamp < end
+
+        start and end are iso formatted timestamps (UTC)
+        """
+        segments = [(self.segment_start(s), s, True) for s in self.compressed_segments()]
+        segments += [
+            (self.segment_start(s), s, False)
+            for s in self.plain_segments() if not os.path.exists(s + '.gz')
+        ]
+        segments.sort()
+        active_start = self.first_timestamp(self.filename)
+        for i, (segment_start, segment, compressed) in enumerate(segments):
+            next_start = segments[i+1][0] if i + 1 < len(segments) else active_start
+            if segment_start >= end:
+                break
+            if next_start and next_start <= start:
+                continue
+            try:
+                if compressed:
+                    yield from self.read_compressed(segment, start, end)
+                else:
+                    yield from self.read_plain(segment, start, end)
+            except FileNotFoundError:
+                # The segment was compressed while we were looking at it
+                yield from self.read_compressed(segment + '.gz', start, end)
+        if active_start and active_start < end:
+            yield from self.read_plain(self.filename, start, end)
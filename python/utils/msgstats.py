@@ -0,0 +1,157 @@
+"""Local message statistics for Felix
+
+Counts messages per day, per user and per channel in a SQLite database so
+graphs and stats can be answered with one range query instead of one
+request per day to the emkc api.
+
+Counts are collected in memory by add() and written to the database by
+flush(). All database access runs on a single worker thread, so the
+async methods never block the event loop.
+
+Callbacks registered with add_listener() are called with the set of days
+(iso formatted dates) that received new messages after every flush.
+"""
+import asyncio
+import sqlite3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS message_counts (
+    day TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    messages INTEGER NOT NULL,
+    PRIMARY KEY (day, user_id, channel_id)
+);
+CREATE INDEX IF NOT EXISTS message_counts_user ON message_counts (user_id, day);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+'''
+
+
+class MessageStatsStore:
+    def __init__(self, filename):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # Key: (day, user_id, channel_id) | Value: number of new messages
+        self.pending = Counter()
+        self.user_names = {}
+        self.channel_names = {}
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def add(self, day, user_id, user_name, channel_id, channel_name):
+        """Count one message
+
+        Arguments:
+            day {str} -- iso formatted date (UTC) the message was sent on
+        """
+        self.pending[(day, user_id, channel_id)] += 1
+        self.user_names[user_id] = user_name
+        self.channel_names[channel_id] = channel_name
+
+    async def run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    # ----------------------------------------------
+    # Writing
+    # ----------------------------------------------
+    def take_pending(self):
+        pending = (self.pending, self.user_names, self.channel_names)
+        self.pending = Counter()
+        self.user_names = {}
+        self.channel_names = {}
+        return pending
+
+    def write(self, counts, user_names, channel_names):
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO message_counts (day, user_id, channel_id, messages) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (day, user_id, channel_id) '
+                'DO UPDATE SET messages = messages + excluded.messages',
+                [(*key, n) for key, n in counts.items()]
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO users (user_id, name) VALUES (?, ?)',
+                user_names.items()
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO channels (channel_id, name) VALUES (?, ?)',
+                channel_names.items()
+            )
+
+    async def flush(self):
+        """Write the counted messages to the database"""
+        if not self.pending:
+            return
+        counts, user_names, channel_names = self.take_pending()
+        await self.run(self.write, counts, user_names, channel_names)
+        days = {day for day, _, _ in counts}
+        for callback in self.listeners:
+            callback(days)
+
+    def close(self):
+        if self.pending:
+            self.executor.submit(self.write, *self.take_pending())
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+    # ----------------------------------------------
+    # Queries - start and end are iso formatted dates, both inclusive
+    # ----------------------------------------------
+    def query(self, sql, params):
+        return self.db.execute(sql, params).fetchall()
+
+    async def top_users(self, start, end, limit=0, user_ids=None):
+        """Return a list of (user_id, name, messages) sorted by messages"""
+        sql = (
+            'SELECT c.user_id, COALESCE(u.name, CAST(c.user_id AS TEXT)), '
+            'SUM(c.messages) AS total '
+            'FROM message_counts c LEFT JOIN users u ON u.user_id = c.user_id '
+            'WHERE c.day BETWEEN ? AND ?'
+        )
+        params = [start, end]
+        if user_ids:
+            sql += f' AND c.user_id IN ({",".join("?" * len(user_ids))})'
+            params += list(user_ids)
+        sql += ' GROUP BY c.user_id ORDER BY total DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return await self.run(self.query, sql, params)
+
+    async def daily_user_counts(self, start, end, user_ids):
+        """Return a dict {user_id: {day: messages}}"""
+        sql = (
+            'SELECT day, user_id, SUM(messages) FROM message_counts '
+            'WHERE day BETWEEN ? AND ? '
+            f'AND user_id IN ({",".join("?" * len(user_ids))}) '
+            'GROUP BY day, user_id'
+        )
+        rows = await self.run(self.query, sql, [start, end, *user_ids])
+        result = {user_id: {} for user_id in user_ids}
+        for day, user_id, messages in rows:
+            result[user_id][day] = messages
+        return result
+
+    async def daily_counts(self, start, end):
+        """Return a dict {day: messages} for the whole server"""
+        sql = (
+            'SELECT day, SUM(messages) FROM message_counts '
+            'WHERE day BETWEEN ? AND ? GROUP BY day'
+        )
+        return dict(await self.run(self.query, sql, [start, end]))
@@ -0,0 +1,158 @@
+"""Outbound message queue for Felix
+
+Commands that send several messages in a row queue them in client.outbox
+instead of calling ctx.send() for every page:
+
+    await self.client.outbox.send(ctx.channel, 'Some text')
+    await self.client.outbox.send_block(ctx.channel, lines, lang='css')
+
+Every channel has its own queue. Messages that are queued within delay
+seconds are packed into as few Discord messages as possible: contents are
+joined up to MAX_CONTENT characters and a message carries at most one embed.
+A channel gets at most rate messages per per seconds, so long outputs do not
+run into 429 responses. send() and send_block() return a future of the
+Discord message that carries the (last part of the) content.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from discord import Embed, HTTPException
+
+MAX_CONTENT = 2000  # Characters of one message
+
+
+def split_content(content, limit=MAX_CONTENT):
+    """Split content into parts of at most limit characters - at newlines if possible"""
+    parts = []
+    part = []
+    length = 0
+    for line in content.split('\n'):
+        while len(line) > limit:
+            parts.extend(['\n'.join(part)] if part else [])
+            part, length = [], 0
+            parts.append(line[:limit])
+            line = line[limit:]
+        if part and length + 1 + len(line) > limit:
+            parts.append('\n'.join(part))
+            part, length = [], 0
+        length += len(line) + bool(part)
+        part.append(line)
+    if part:
+        parts.append('\n'.join(part))
+    return parts
+
+
+@dataclass
+class QueuedMessage:
+    content: str
+    embed: Embed
+    future: asyncio.Future
+
+
+class ChannelQueue:
+    def __init__(self, channel, delay, rate, per):
+        self.channel = channel
+        self.delay = delay
+        self.per = per
+        self.messages = deque()
+        # Times of the last rate messages that were sent
+        self.sent = deque(maxlen=rate)
+        self.task = None
+
+    def put(self, content, embed):
+        future = asyncio.get_event_loop().create_future()
+        # Errors are raised to the callers that await the future - the others ignore them
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.messages.append(QueuedMessage(content, embed, future))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return future
+
+    def take_batch(self):
+        """Take the queued messages that fit into one Discord message"""
+        batch = [self.messages.popleft()]
+        length = len(batch[0].content or '')
+        has_embed = batch[0].embed is not None
+        # Nothing is packed after an embed - the content would appear above it
+        while self.messages and not has_embed:
+            queued = self.messages[0]
+            if queued.content and length + 1 + len(queued.content) > MAX_CONTENT:
+                break
+            self.messages.popleft()
+            batch.append(queued)
+            if queued.content:
+                length += len(queued.content) + bool(length)
+            has_embed = queued.embed is not None
+        return batch
+
+    async def wait_for_rate_limit(self):
+        if len(self.sent) == self.sent.maxlen:
+            wait = self.sent[0] + self.per - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def run(self):
+        try:
+            # Collect the messages that are sent right after this one
+            await asyncio.sleep(self.delay)
+            while self.messages:
+                await self.wait_for_rate_limit()
+                batch = self.take_batch()
+                content = '\n'.join(queued.content for queued in batch if queued.content)
+                embed = next((queued.embed for queued in batch if queued.embed), None)
+                try:
+                    message = await self.channel.send(content or None, embed=embed)
+                except HTTPException as e:
+                    for queued in batch:
+                        if not queued.future.done():
+                            queued.future.set_exception(e)
+                    continue
+                finally:
+                    self.sent.append(time.monotonic())
+                for queued in batch:
+                    if not queued.future.done():
+                        queued.future.set_result(message)
+        finally:
+            self.task = None
+            # Only left over if the task was cancelled
+            while self.messages:
+                self.messages.popleft().future.cancel()
+
+
+class Outbox:
+    def __init__(self, delay=0.3, rate=5, per=5):
+        self.delay = delay
+        self.rate = rate
+        self.per = per
+        # Key: channel id | Value: ChannelQueue
+        self.queues = {}
+
+    def queue(self, channel):
+        if channel.id not in self.queues:
+            self.queues[channel.id] = ChannelQueue(channel, self.delay, self.rate, self.per)
+        return self.queues[channel.id]
+
+    def send(self, channel, content=None, *, embed=None):
+        """Queue a message - content longer than MAX_CONTENT is split at newlines"""
+        queue = self.queue(channel)
+        if content is None:
+            return queue.put(None, embed)
+        parts = split_content(str(content))
+        for part in parts[:-1]:
+            queue.put(part, None)
+        return queue.put(parts[-1], embed)
+
+    def send_block(self, channel, lines, lang=''):
+        """Queue lines as code blocks of at most MAX_CONTENT characters"""
+        prefix = f'```{lang}\n'
+        suffix = '\n```'
+        parts = split_content('\n'.join(lines), MAX_CONTENT - len(prefix) - len(suffix))
+        queue = self.queue(channel)
+        futures = [queue.put(prefix + part + suffix, None) for part in parts]
+        return futures[-1]
+
+    def cancel(self):
+        for queue in self.queues.values():
+            if queue.task is not None:
+                queue.task.cancel()
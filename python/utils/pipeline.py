@@ -0,0 +1,109 @@
+"""Message dispatch pipeline for Felix
+
+Instead of every cog registering its own on_message listener, cogs add a
+stage to client.message_pipeline. Every message is classified once and all
+stages run in order with the same MessageContext.
+
+    self.client.message_pipeline.add_stage('linkblocker', self.on_message, 20)
+    self.client.message_pipeline.remove_stage('linkblocker')  # in cog_unload
+
+A stage is a coroutine function that receives the MessageContext.
+If it returns True the message is considered handled and no later stage
+(and no command) will see it.
+"""
+import sys
+import traceback
+from datetime import datetime
+from dataclasses import dataclass
+from discord import DMChannel, Message
+
+
+@dataclass
+class MessageContext:
+    msg: Message
+    is_dm: bool
+    is_bot: bool
+    is_self: bool
+    is_admin: bool
+    is_main_guild: bool
+
+    @property
+    def author(self):
+        return self.msg.author
+
+    @property
+    def channel(self):
+        return self.msg.channel
+
+    @property
+    def guild(self):
+        return self.msg.guild
+
+
+@dataclass
+class Stage:
+    name: str
+    callback: object
+    priority: int
+    bots: bool = False
+    dms: bool = False
+
+
+class MessagePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.stages = []
+
+    def add_stage(self, name, callback, priority, *, bots=False, dms=False):
+        """Add a stage - a stage with the same name is replaced
+
+        Arguments:
+            name {str} -- Unique name of the stage
+            callback {coroutine function} -- Called with the MessageContext
+            priority {int} -- Stages with a lower priority run first
+
+        Keyword Arguments:
+            bots {bool} -- Run for messages of bots, including
+                           the bots own messages (default: {False})
+            dms {bool} -- Run for direct messages (default: {False})
+        """
+        self.remove_stage(name)
+        self.stages.append(Stage(name, callback, priority, bots, dms))
+        self.stages.sort(key=lambda stage: stage.priority)
+
+    def remove_stage(self, name):
+        self.stages = [stage for stage in self.stages if stage.name != name]
+
+    def classify(self, msg):
+        """Compute everything stages commonly need to know about a message"""
+        main_guild = getattr(self.client, 'main_guild', None)
+        return MessageContext(
+            msg=msg,
+            is_dm=isinstance(msg.channel, DMChannel),
+            is_bot=msg.author.bot,
+            is_self=msg.author == self.client.user,
+            is_admin=self.client.user_is_admin(msg.author),
+            is_main_guild=(
+                main_guild is not None
+                and msg.guild is not None
+                and msg.guild.id == main_guild.id
+            ),
+        )
+
+    async def dispatch(self, msg):
+        """Run all stages for msg - return True if a stage handled the message"""
+        ctx = self.classify(msg)
+        for stage in self.stages:
+            if ctx.is_bot and not stage.bots:
+                continue
+            if ctx.is_dm and not stage.dms:
+                continue
+            try:
+                if await stage.callback(ctx):
+                    return True
+            except Exception as e:
+                # One failing stage must not stop the others
+                print(f'Ignoring exception in message stage {stage.name}', file=sys.stderr)
+                traceback.print_exc()
+                self.client.last_errors.append((e, datetime.utcnow(), msg, msg.content))
+        return False
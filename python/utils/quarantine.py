@@ -0,0 +1,150 @@
+"""Quarantine for forbidden attachments
+
+Attachments are streamed into a SpooledTemporaryFile (kept in memory up to
+SPOOL_MEMORY bytes, then moved to disk) and hashed while they are
+downloaded, so a file is never held in memory as a whole. Files larger than
+max_size are not kept - only their size is known then.
+
+KnownBadFiles remembers the quarantined files. Each entry holds the
+SHA-256 of the file plus its size and the SHA-256 of its first PREFIX_SIZE
+bytes. A re-upload is recognised by its size and a ranged request for its
+first bytes, without downloading the whole file.
+"""
+import asyncio
+import hashlib
+from dataclasses import dataclass
+from tempfile import SpooledTemporaryFile
+from aiohttp import ClientError
+from discord import File
+
+SPOOL_MEMORY = 1_000_000  # Bytes
+CHUNK_SIZE = 65536  # Bytes
+PREFIX_SIZE = 16384  # Bytes
+
+
+@dataclass
+class QuarantinedFile:
+    filename: str
+    size: int
+    sha256: str = None
+    # SHA-256 of the first PREFIX_SIZE bytes
+    prefix_sha256: str = None
+    file: SpooledTemporaryFile = None
+    # True if the file was recognised by KnownBadFiles
+    known: bool = False
+
+    def to_discord_file(self):
+        self.file.seek(0)
+        # SpooledTemporaryFile is no io.IOBase before Python 3.11 - discord.File
+        # would try to open() it. Pass the BytesIO or temporary file it wraps.
+        return File(self.file._file, filename=self.filename)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+async def quarantine(session, attachment, max_size):
+    """Download and hash an attachment - return a QuarantinedFile
+
+    The file is only kept if the download succeeded and is not larger
+    than max_size bytes.
+    """
+    quarantined = QuarantinedFile(attachment.filename, attachment.size)
+    if attachment.size > max_size:
+        return quarantined
+    spool = SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    sha256 = hashlib.sha256()
+    prefix_sha256 = hashlib.sha256()
+    size = 0
+    try:
+        async with session.get(attachment.url) as response:
+            if response.status != 200:
+                spool.close()
+                return quarantined
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    spool.close()
+                    return quarantined
+                if size - len(chunk) < PREFIX_SIZE:
+                    prefix_sha256.update(chunk[:PREFIX_SIZE - (size - len(chunk))])
+                sha256.update(chunk)
+                spool.write(chunk)
+    except (ClientError, asyncio.TimeoutError):
+        spool.close()
+        return quarantined
+    quarantined.sha256 = sha256.hexdigest()
+    quarantined.prefix_sha256 = prefix_sha256.hexdigest()
+    quarantined.file = spool
+    return quarantined
+
+
+async def fetch_prefix_hash(session, url):
+    """Return the SHA-256 of the first PREFIX_SIZE bytes of url or None"""
+    headers = {'Range': f'bytes=0-{PREFIX_SIZE - 1}'}
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status not in (200, 206):
+                return None
+            # Servers that ignore the range send the whole file - only read the prefix
+            prefix = b''
+            while len(prefix) < PREFIX_SIZE:
+                chunk = await response.content.read(PREFIX_SIZE - len(prefix))
+                if not chunk:
+                    break
+                prefix += chunk
+    except (ClientError, asyncio.TimeoutError):
+        return None
+    return hashlib.sha256(prefix).hexdigest()
+
+
+class KnownBadFiles:
+    """Hashes of quarantined files - stored in the bot state"""
+
+    def __init__(self, state, key='bad_attachments', max_entries=10_000):
+        self.state = state
+        self.key = key
+        self.max_entries = max_entries
+        # Key: sha256 | Value: {"size": size, "prefix": sha256 of the first bytes}
+        self.entries = state.get(key, {})
+        self.build_index()
+
+    def build_index(self):
+        # Key: (size, prefix hash) | Value: sha256
+        self.index = {
+            (entry['size'], entry['prefix']): sha256
+            for sha256, entry in self.entries.items()
+        }
+        self.sizes = {size for size, _ in self.index}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def might_be_known(self, size):
+        """Cheap check before the prefix is downloaded"""
+        return size in self.sizes
+
+    def lookup(self, size, prefix_sha256):
+        """Return the sha256 of the known file or None"""
+        return self.index.get((size, prefix_sha256))
+
+    def add(self, quarantined):
+        if quarantined.sha256 is None or quarantined.sha256 in self.entries:
+            return
+        self.entries[quarantined.sha256] = {
+            'size': quarantined.size,
+            'prefix': quarantined.prefix_sha256,
+        }
+        while len(self.entries) > self.max_entries:
+            # Drop the oldest entry
+            del self.entries[next(iter(self.entries))]
+        self.build_index()
+        self.state.set(self.key, self.entries)
+
+    def remove(self, sha256):
+        if self.entries.pop(sha256, None) is None:
+            return False
+        self.build_index()
+        self.state.set(self.key, self.entries)
+        return True
@@ -0,0 +1,47 @@
+"""Graph rendering for Felix
+
+The functions in this module run in a worker process (see cogs/graph.py).
+They only take plain data, build their own Figure with the Agg canvas
+(no global pyplot state) and return the rendered PNG as bytes.
+
+This module requires matplotlib:
+    pip install -U matplotlib
+"""
+from io import BytesIO
+from matplotlib.figure import Figure
+
+
+def figure_to_png(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+
+def render_messages_graph(series, xlabel):
+    """Render one line per user
+
+    Arguments:
+        series {list} -- list of (label, xaxis, yaxis) tuples
+        xlabel {str} -- Label of the x axis
+    """
+    fig = Figure()
+    ax = fig.subplots()
+    for label, xaxis, yaxis in series:
+        ax.plot(xaxis, yaxis, label=label, marker='o', markersize=3)
+    ax.legend()
+    ax.set_ylabel('Messages')
+    ax.set_xlabel(xlabel)
+    return figure_to_png(fig)
+
+
+def render_server_graph(values_x, values_y):
+    """Render the server activity graph"""
+    fig = Figure()
+    ax = fig.subplots()
+    ax.plot(values_x, values_y, marker='o', markersize=3)
+    ax.set_ylabel('Messages')
+    ax.set_xlabel('Date')
+    ax.set_ylim(ymin=0)
+    ax.grid(True)
+    ax.tick_params(axis='x', labelrotation=90)
+    return figure_to_png(fig)
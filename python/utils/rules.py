@@ -0,0 +1,76 @@
+"""A small rule engine to match many trigger patterns against a message
+
+All registered patterns are combined into one precompiled alternation so a
+message is scanned once, no matter how many rules exist. Every rule is
+wrapped in a lookahead, so the scan only finds the positions where a rule
+starts - the rules still match independently of each other, even if their
+matches overlap.
+
+    rules = RuleEngine()
+    rules.add(r'^felix meow', 'ฅ^•ﻌ•^ฅ')
+    for responder, match in rules.scan(msg.content):
+        ...
+
+Patterns must not use inline flags, pass the flags to the RuleEngine instead.
+Named groups must be unique across all rules of one engine.
+"""
+import re
+
+
+class RuleEngine:
+    def __init__(self, flags=re.IGNORECASE):
+        self.flags = flags
+        # Key: group name | Value: (pattern, responder)
+        self.rules = {}
+        # Key: group name | Value: compiled pattern of the rule
+        self.compiled = {}
+        self._regex = None
+
+    def add(self, pattern, responder):
+        """Register a rule
+
+        Arguments:
+            pattern {str} -- The regular expression that triggers the rule
+            responder -- Anything, it is returned by scan() if the rule matched
+        """
+        name = f'_rule{len(self.rules)}'
+        self.rules[name] = (pattern, responder)
+        self.compiled[name] = re.compile(pattern, self.flags)
+        self._regex = None
+
+    @property
+    def regex(self):
+        """The combined pattern - compiled on first use after a change"""
+        if self._regex is None:
+            alternation = '|'.join(
+                f'(?P<{name}>{pattern})' for name, (pattern, _) in self.rules.items()
+            )
+            self._regex = re.compile(f'(?=(?:{alternation}))', self.flags)
+        return self._regex
+
+    def scan(self, text):
+        """Scan text once and return a list of (responder, match) tuples
+
+        Every rule appears at most once (with its first match) and the rules
+        are returned in the order they were added.
+        """
+        if not self.rules:
+            return []
+        found = {}
+        names = list(self.rules)
+        # The lookahead matches are empty, finditer tries every position once
+        for match in self.regex.finditer(text):
+            pos = match.start()
+            # The alternation tried the rules in order - the rules before the
+            # one that matched do not match at pos, the later ones might
+            for name in names[names.index(match.lastgroup):]:
+                if name not in found:
+                    rule_match = self.compiled[name].match(text, pos)
+                    if rule_match is not None:
+                        found[name] = rule_match
+            if len(found) == len(names):
+                break
+        return [
+            (responder, found[name])
+            for name, (_, responder) in self.rules.items() if name in found
+        ]
@@ -0,0 +1,47 @@
+"""Single-flight calls for Felix
+
+If a call with the same key is already running, do() waits for its result
+instead of starting the call again:
+
+    key = SingleFlight.url_key(url, params)
+    data = await self.client.singleflight.do(key, self.fetch_data, url, params)
+
+Every caller gets the same result (or the same exception).
+"""
+import asyncio
+from yarl import URL
+
+
+class SingleFlight:
+    def __init__(self):
+        # Key: key | Value: task of the running call
+        self.calls = {}
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    def __len__(self):
+        return len(self.calls)
+
+    def start(self, key, func, *args, **kwargs):
+        """Start func(*args, **kwargs) or return the task of the running call for key"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        return task
+
+    async def do(self, key, func, *args, **kwargs):
+        # A cancelled caller must not cancel the call of the others
+        return await asyncio.shield(self.start(key, func, *args, **kwargs))
+
+    @staticmethod
+    def url_key(url, params=None, headers=None):
+        """Return a key for a request - the order of query parameters and
+        headers does not matter"""
+        url = URL(str(url))
+        if params:
+            url = url.update_query(params)
+        url = url.with_query(sorted(url.query.items()))
+        return f'{url}|{sorted((headers or {}).items())}'
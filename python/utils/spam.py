@@ -0,0 +1,219 @@
+"""Spam detection helpers for Felix"""
+import re
+import time
+import unicodedata
+from collections import deque
+from utils.ttl import TTLMap
+
+
+class SpamDetector:
+    """Detect users that send num_msg messages within period seconds
+
+    Every user has a ring buffer of the timestamps of his last messages, so
+    checking a message costs O(1). Users that did not write for period
+    seconds are forgotten and at most max_users buffers are kept.
+
+    channel_limits maps channel ids to their own (num_msg, period) - messages
+    in such a channel are counted separately from the other channels.
+    """
+
+    def __init__(self, num_msg, period, channel_limits=None, max_users=100_000):
+        self.num_msg = num_msg
+        self.period = period
+        self.channel_limits = channel_limits or {}
+        longest = max([period] + [p for _, p in self.channel_limits.values()])
+        # Key: user id or (user id, channel id) | Value: deque of timestamps
+        self.histories = TTLMap(longest, maxsize=max_users)
+
+    def hit(self, user_id, channel_id, now=None):
+        """Count a message - return True if the user exceeded the limit
+
+        The history of the user is reset when True is returned.
+        """
+        now = time.monotonic() if now is None else now
+        if channel_id in self.channel_limits:
+            num_msg, period = self.channel_limits[channel_id]
+            key = (user_id, channel_id)
+        else:
+            num_msg, period = self.num_msg, self.period
+            key = user_id
+        history = self.histories.get(key)
+        if history is None:
+            history = deque(maxlen=num_msg)
+        history.append(now)
+        exceeded = len(history) == num_msg and now - history[0] < period
+        if exceeded:
+            history.clear()
+        self.histories.set(key, history)
+        return exceeded
+
+    def expire(self):
+        return self.histories.expire()
+
+
+class DuplicateDetector:
+    """Detect the same content being posted in many channels or by many accounts
+
+    Content is normalized (case, accents, punctuation, whitespace and
+    mentions are ignored) and only its hash is stored. Entries expire
+    window seconds after the content was last seen.
+    """
+
+    NON_WORD = re.compile(r'<[@#][!&]?\d+>|[\W_]+')
+
+    def __init__(self, window, max_channels, max_accounts, min_length=20, max_entries=100_000):
+        self.max_channels = max_channels
+        self.max_accounts = max_accounts
+        self.min_length = min_length
+        # Key: (user id, fingerprint) | Value: set of channel ids
+        self.user_posts = TTLMap(window, maxsize=max_entries)
+        # Key: fingerprint | Value: set of user ids
+        self.global_posts = TTLMap(window, maxsize=max_entries)
+
+    def fingerprint(self, content):
+        """Return the hash of the normalized content or None if it is too short"""
+        text = unicodedata.normalize('NFKD', content.casefold())
+        text = self.NON_WORD.sub('', text)
+        if len(text) < self.min_length:
+            return None
+        return hash(text)
+
+    def hit(self, user_id, channel_id, content, count_account=True):
+        """Count a message
+
+        If count_account is False the message only counts for the cross
+        channel check of its user, not towards max_accounts.
+
+        Returns:
+            tuple -- (cross_channel, accounts, first_report)
+                     cross_channel is True if the user posted the content in
+                     max_channels channels. accounts is the set of accounts that
+                     posted the content once max_accounts accounts posted it -
+                     it is empty most of the time. first_report is True if the
+                     content just reached max_accounts, the accounts after that
+                     are returned one by one with first_report False.
+        """
+        fingerprint = self.fingerprint(content)
+        if fingerprint is None:
+            return False, set(), False
+
+        channels = self.user_posts.get((user_id, fingerprint), set())
+        channels.add(channel_id)
+        cross_channel = len(channels) >= self.max_channels
+        if cross_channel:
+            # Start over, so the user is only reported once
+            self.user_posts.pop((user_id, fingerprint))
+        else:
+            self.user_posts.set((user_id, fingerprint), channels)
+
+        if not count_account:
+            return cross_channel, set(), False
+        users = self.global_posts.get(fingerprint, set())
+        known = user_id in users
+        users.add(user_id)
+        self.global_posts.set(fingerprint, users)
+        if len(users) < self.max_accounts or known:
+            return cross_channel, set(), False
+        if len(users) == self.max_accounts:
+            return cross_channel, set(users), True
+        # The others were reported already
+        return cross_channel, {user_id}, False
+
+    def expire(self):
+        return self.user_posts.expire() + self.global_posts.expire()
+
+
+class BucketCounter:
+    """Count events of the last period seconds in a fixed number of buckets
+
+    Memory and cost per event don't depend on the number of events.
+    """
+
+    def __init__(self, period, buckets=10):
+        self.period = period
+        self.bucket_size = period / buckets
+        # Entries: [bucket number, number of events]
+        self.buckets = deque()
+        self.total = 0
+
+    def drop_old(self, now):
+        oldest = int((now - self.period) // self.bucket_size)
+        while self.buckets and self.buckets[0][0] <= oldest:
+            self.total -= self.buckets.popleft()[1]
+
+    def add(self, now, n=1):
+        self.drop_old(now)
+        bucket = int(now // self.bucket_size)
+        if self.buckets and self.buckets[-1][0] == bucket:
+            self.buckets[-1][1] += n
+        else:
+            self.buckets.append([bucket, n])
+        self.total += n
+
+    def count(self, now):
+        self.drop_old(now)
+        return self.total
+
+
+class FloodWindow:
+    """Trips when limit joins with a score of at least min_score happen within period seconds"""
+
+    def __init__(self, period, limit, min_score=0):
+        self.period = period
+        self.limit = limit
+        self.min_score = min_score
+        self.counter = BucketCounter(period)
+        # Key: member id | Value: join time - only the joins that count for this window.
+        # The window trips at limit joins, so twice that many are always enough.
+        self.recent_joins = TTLMap(period, maxsize=limit * 2)
+        # True while the join count is at or above limit
+        self.tripped = False
+
+    def __str__(self):
+        text = f'{self.limit} users joined within {self.period} seconds'
+        if self.min_score:
+            text += f' (suspicion score {self.min_score} or higher)'
+        return text
+
+
+class JoinFloodMonitor:
+    """Watch the join rate in multiple windows
+
+    windows is a list of (period, limit, min_score) tuples. Slow raids are
+    caught by long windows that only count suspicious accounts (see the
+    suspicion score in cogs/jail.py).
+    """
+
+    def __init__(self, windows):
+        self.windows = [FloodWindow(*window) for window in windows]
+
+    def add(self, member_id, score, now=None):
+        """Count a join
+
+        Returns:
+            tuple -- (tripped, newly_tripped)
+                     the lists of windows that are tripped and of the windows
+                     that tripped with this join
+        """
+        now = time.monotonic() if now is None else now
+        tripped = []
+        newly_tripped = []
+        for window in self.windows:
+            if score >= window.min_score:
+                window.counter.add(now)
+                window.recent_joins.set(member_id, now)
+            was_tripped = window.tripped
+            window.tripped = window.counter.count(now) >= window.limit
+            if window.tripped:
+                tripped.append(window)
+                if not was_tripped:
+                    newly_tripped.append(window)
+        return tripped, newly_tripped
+
+    def suspects(self, window, now=None):
+        """Return the ids of the recent joins that count for window"""
+        now = time.monotonic() if now is None else now
+        return [
+            member_id for member_id, joined in window.recent_joins.items()
+            if now - joined < window.period
+        ]
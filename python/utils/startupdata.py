@@ -0,0 +1,104 @@
+"""Data that cogs fetch from third party sites when the bot starts
+
+    self.data = StartupData(client, 'general')
+    self.data.register('cat_codes', load_cat_codes, default=[])
+    self.data_task = client.loop.create_task(self.data.run())
+    ...
+    self.data.get('cat_codes')
+
+A loader is a coroutine function that receives the aiohttp session and
+returns a json serializable value. It raises an exception if the site
+returned an error. Every value is cached on disk - failed loads and empty
+values never replace a cached value. At startup
+the cached values are served immediately (even if they are older than ttl)
+while outdated values are fetched concurrently in the background. After that
+all values are refreshed every ttl seconds. Until a value was loaded get()
+returns its default.
+"""
+import asyncio
+import json
+import os
+import time
+
+CACHE_DIR = '../cache'
+
+
+class StartupData:
+    def __init__(self, client, name, ttl=86400, timeout=10):
+        self.client = client
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+        # Key: name | Value: (loader, default)
+        self.loaders = {}
+        self.values = {}
+
+    def register(self, name, loader, default=None):
+        self.loaders[name] = (loader, default)
+
+    def get(self, name):
+        return self.values.get(name, self.loaders[name][1])
+
+    # ----------------------------------------------
+    # Disk cache - these block, run them in an executor
+    # ----------------------------------------------
+    def cache_file(self, name):
+        return os.path.join(CACHE_DIR, f'{self.name}_{name}.json')
+
+    def read_cache(self, name):
+        """Return (time of the fetch, value) or None"""
+        try:
+            with open(self.cache_file(name)) as cachefile:
+                cached = json.load(cachefile)
+            return cached['fetched'], cached['value']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def write_cache(self, name, value):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        filename = self.cache_file(name)
+        with open(filename + '.tmp', 'w') as cachefile:
+            json.dump({'fetched': time.time(), 'value': value}, cachefile)
+        os.replace(filename + '.tmp', filename)
+
+    # ----------------------------------------------
+    # Loading
+    # ----------------------------------------------
+    async def refresh(self, name):
+        loader, _ = self.loaders[name]
+        try:
+            value = await asyncio.wait_for(loader(self.client.session), self.timeout)
+        except Exception as e:
+            # Any error of a loader (a changed site, ...) must not end the refresh loop
+            print(f'WARNING: could not load {self.name} {name}. {type(e).__name__}: {e}')
+            return
+        if not value:
+            print(f'WARNING: could not load {self.name} {name}. Empty result')
+            return
+        self.values[name] = value
+        try:
+            await self.client.loop.run_in_executor(None, self.write_cache, name, value)
+        except (OSError, TypeError, ValueError) as e:
+            print(f'WARNING: could not cache {self.name} {name}. {type(e).__name__}: {e}')
+
+    async def load(self):
+        """Serve the cached values and fetch the missing and outdated ones"""
+        outdated = []
+        for name in self.loaders:
+            cached = await self.client.loop.run_in_executor(None, self.read_cache, name)
+            if cached is None:
+                outdated.append(name)
+                continue
+            fetched, self.values[name] = cached
+            if time.time() - fetched > self.ttl:
+                outdated.append(name)
+        if outdated:
+            # The session is created when the bot starts
+            await self.client.wait_until_ready()
+            await asyncio.gather(*(self.refresh(name) for name in outdated))
+
+    async def run(self):
+        await self.load()
+        while True:
+            await asyncio.sleep(self.ttl)
+            await asyncio.gather(*(self.refresh(name) for name in self.loaders))
@@ -0,0 +1,252 @@
+"""Persistent bot state for Felix
+
+The state is loaded once and kept in memory. Every top level key is a
+namespace owned by one cog (e.g. "jailed", "stats").
+
+    state = client.state
+    stats = state.get('stats', {})
+    state.set('stats', stats)
+
+Reads are served from memory. set() marks the namespace as changed and
+schedules a write, so many changes within flush_delay seconds result in
+one write. get() returns the stored object itself - call set() after
+changing it.
+
+Namespaces that hold a set of ids (e.g. "jailed") use the member methods
+instead of get/set:
+
+    state.add_members('jailed', [member.id])
+    await state.contains('jailed', member.id)
+
+Two backends exist, use open_state_store() to create the configured one:
+    json    ../state.json - written to a temporary file, then renamed
+    sqlite  ../state.db - member namespaces are stored as indexed rows
+            and changed incrementally. On the first start the data of
+            ../state.json is imported.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StateStore:
+    """State stored in a json file"""
+
+    def __init__(self, filename, flush_delay=2):
+        self.filename = filename
+        self.flush_delay = flush_delay
+        # One thread, so writes can't overtake each other
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.flush_handle = None
+        self.dirty = set()
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as statefile:
+                return json.load(statefile)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.mark_dirty(key)
+
+    def delete(self, key):
+        if self.data.pop(key, None) is not None:
+            self.mark_dirty(key)
+
+    # ----------------------------------------------
+    # Member namespaces
+    # ----------------------------------------------
+    def member_set(self, key):
+        members = self.data.get(key)
+        if not isinstance(members, set):
+            members = set(members or [])
+            self.data[key] = members
+        return members
+
+    def members(self, key):
+        """Return a copy of all members of a namespace"""
+        return set(self.member_set(key))
+
+    def add_members(self, key, members):
+        self.member_set(key).update(members)
+        self.mark_dirty(key)
+
+    def remove_members(self, key, members):
+        self.member_set(key).difference_update(members)
+        self.mark_dirty(key)
+
+    async def contains(self, key, member):
+        return member in self.member_set(key)
+
+    # ----------------------------------------------
+    # Writing
+    # ----------------------------------------------
+    def mark_dirty(self, key):
+        self.dirty.add(key)
+        if self.flush_handle is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self.flush_handle = loop.call_later(self.flush_delay, self.flush_in_background)
+
+    def flush_in_background(self):
+        self.flush_handle = None
+        dirty, self.dirty = self.dirty, set()
+        # Serialize on the loop so the snapshot is consistent
+        self.executor.submit(self.write, self.serialize(dirty))
+
+    def serialize(self, dirty):
+        return json.dumps(self.data, indent=1, default=sorted)
+
+    def write(self, text):
+        tmp_filename = f'{self.filename}.tmp'
+        with open(tmp_filename, 'w') as statefile:
+            statefile.write(text)
+            statefile.flush()
+            os.fsync(statefile.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    def flush(self):
+        """Write pending changes now and wait for all writes to finish"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_in_background()
+        self.executor.submit(lambda: None).result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+
+class SqliteStateStore(StateStore):
+    """State stored in a SQLite database
+
+    All writes run on the writer thread. Member namespaces are not kept in
+    memory, membership checks are primary key lookups.
+    """
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS state_members (
+        key TEXT NOT NULL,
+        member INTEGER NOT NULL,
+        PRIMARY KEY (key, member)
+    ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, filename, flush_delay=2, import_from=None, member_keys=()):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        if import_from and self.is_empty():
+            self.import_json(import_from, member_keys)
+        super().__init__(filename, flush_delay)
+
+    def is_empty(self):
+        return not any(
+            self.db.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+            for table in ('state', 'state_members')
+        )
+
+    def import_json(self, filename, member_keys):
+        try:
+            with open(filename, 'r') as statefile:
+                data = json.load(statefile)
+        except FileNotFoundError:
+            return
+        with self.db:
+            for key, value in data.items():
+                if key in member_keys:
+                    self.db.executemany(
+                        'INSERT OR IGNORE INTO state_members (key, member) VALUES (?, ?)',
+                        [(key, member) for member in value]
+                    )
+                else:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                        (key, json.dumps(value))
+                    )
+
+    def load(self):
+        return {
+            key: json.loads(value)
+            for key, value in self.db.execute('SELECT key, value FROM state')
+        }
+
+    async def run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    # ----------------------------------------------
+    # Member namespaces
+    # ----------------------------------------------
+    def members(self, key):
+        """Return all members of a namespace (blocking - meant for startup)"""
+        self.executor.submit(lambda: None).result()
+        rows = self.db.execute('SELECT member FROM state_members WHERE key = ?', (key,))
+        return {member for member, in rows}
+
+    def add_members(self, key, members):
+        self.executor.submit(
+            self.execute_many,
+            'INSERT OR IGNORE INTO state_members (key, member) VALUES (?, ?)',
+            [(key, member) for member in members]
+        )
+
+    def remove_members(self, key, members):
+        self.executor.submit(
+            self.execute_many,
+            'DELETE FROM state_members WHERE key = ? AND member = ?',
+            [(key, member) for member in members]
+        )
+
+    async def contains(self, key, member):
+        return await self.run(self.query_member, key, member)
+
+    def query_member(self, key, member):
+        return self.db.execute(
+            'SELECT 1 FROM state_members WHERE key = ? AND member = ?', (key, member)
+        ).fetchone() is not None
+
+    def execute_many(self, sql, rows):
+        with self.db:
+            self.db.executemany(sql, rows)
+
+    # ----------------------------------------------
+    # Writing
+    # ----------------------------------------------
+    def serialize(self, dirty):
+        return [(key, json.dumps(self.data[key]) if key in self.data else None) for key in dirty]
+
+    def write(self, changes):
+        with self.db:
+            for key, value in changes:
+                if value is None:
+                    self.db.execute('DELETE FROM state WHERE key = ?', (key,))
+                else:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value)
+                    )
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+
+def open_state_store(config, member_keys=()):
+    """Create the state store selected by config['state_backend']"""
+    if config.get('state_backend', 'json') == 'sqlite':
+        return SqliteStateStore(
+            config.get('state_db', '../state.db'),
+            import_from='../state.json',
+            member_keys=member_keys
+        )
+    return StateStore('../state.json')
@@ -0,0 +1,80 @@
+"""Expiring mapping for Felix"""
+import time
+from collections import OrderedDict
+
+
+class TTLMap:
+    """A dict like map whose entries expire ttl seconds after they were set
+
+    Entries are kept in the order they were set, so expired entries are
+    always at the front and expire() only looks at entries it removes.
+    If maxsize is given, the oldest entries are dropped when the map is full.
+    """
+
+    def __init__(self, ttl, maxsize=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        # Key: key | Value: (expiry time, value)
+        self.data = OrderedDict()
+
+    def __contains__(self, key):
+        entry = self.data.get(key)
+        return entry is not None and entry[0] > self.clock()
+
+    def __len__(self):
+        # Expired entries don't count - an empty map is falsy
+        self.expire()
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None or entry[0] <= self.clock():
+            return default
+        return entry[1]
+
+    def set(self, key, value, expires=None):
+        """Store value - it expires ttl seconds from now or at expires
+
+        Entries with an explicit expiry have to be set in the order they
+        expire, otherwise expire() removes them late.
+        """
+        now = self.clock()
+        self.data[key] = (now + self.ttl if expires is None else expires, value)
+        self.data.move_to_end(key)
+        self.expire(now)
+        if self.maxsize is not None:
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        if entry is None or entry[0] <= self.clock():
+            return default
+        return entry[1]
+
+    def expire(self, now=None):
+        """Remove expired entries - return the number of removed entries"""
+        now = self.clock() if now is None else now
+        removed = 0
+        while self.data:
+            key, (expires, _) = next(iter(self.data.items()))
+            if expires > now:
+                break
+            del self.data[key]
+            removed += 1
+        return removed
+
+    def keys(self):
+        now = self.clock()
+        return [key for key, (expires, _) in self.data.items() if expires > now]
+
+    def items(self):
+        now = self.clock()
+        return [(key, value) for key, (expires, value) in self.data.items() if expires > now]
+
+    def clear(self):
+        self.data.clear()